@@ -0,0 +1,185 @@
+import asyncio
+from openai_client import client_manager
+from rate_limiter import estimate_request_tokens
+from retry_policy import RetryPolicy, error_headers
+from response_cache import request_key
+
+"""
+Concurrent execution of chat completion requests.
+
+The engine sends a batch of requests through one AsyncOpenAI client with up to max_concurrency requests in flight at a
+time, and hands each response to a callback as soon as it arrives, so results come back in whatever order the API
+finishes them. Every request carries a key (a file name, for example) that is passed back with its response, so the
+caller can match responses to their inputs. Jobs are taken from their iterable only as requests complete, so it can be
+a generator fed by the earlier stages of a pipeline, without the whole batch being held in memory. With a rate limiter,
+each request also waits until it fits under the requests-per-minute and tokens-per-minute limits before it is sent.
+Requests that fail with a transient error are sent again according to the retry policy. With a response cache,
+requests that have been sent before are answered from the cache without calling the API.
+
+An attempt that takes longer than request_timeout seconds is abandoned (and retried, like any other timeout), and a run
+can be cancelled from another thread by setting its cancel event: the requests still in flight or waiting are dropped
+and reported with a CancelledError.
+"""
+
+DEFAULT_CONCURRENCY = 8
+CANCEL_POLL_INTERVAL = 0.1  # seconds between checks of the cancel event
+JOBS_PER_SLOT = 2  # jobs taken ahead for each request allowed in flight, so the next one is ready when a slot frees up
+
+
+class AsyncRequestEngine:
+    """
+    Sends chat completion requests concurrently, with at most max_concurrency of them in flight at once.
+    """
+
+    def __init__(self, api_key, max_concurrency=DEFAULT_CONCURRENCY, base_url=None, rate_limiter=None,
+                 retry_policy=None, response_cache=None, request_timeout=None):
+        if max_concurrency < 1:
+            raise ValueError("At least one request must be allowed in flight.")
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.response_cache = response_cache
+        self.request_timeout = request_timeout
+
+    def run(self, jobs, on_result, cancel_event=None):
+        """
+        Send every request in jobs, an iterable of (key, request body, prompt tokens) tuples, and call
+        on_result(key, response, error) for each one as it completes. Prompt tokens is the token count of the prompt,
+        or None to have it counted when a rate limiter needs it. The response is the completion as a dictionary, or None
+        if the request failed, in which case error is the exception. Blocks until every request has completed or, once
+        cancel_event (a threading.Event) is set, been cancelled.
+
+        on_result is called off the event loop, one result at a time, so it may block (to wait for room further down a
+        pipeline, for example). While it does, no new requests are started, but the ones in flight go on.
+        """
+        asyncio.run(self.run_async(jobs, on_result, cancel_event))
+
+    async def run_async(self, jobs, on_result, cancel_event=None):
+        """The coroutine behind run, for callers that already have an event loop."""
+        semaphore = asyncio.BoundedSemaphore(self.max_concurrency)
+        # Jobs are only taken while there is room for them, so an iterator that produces its jobs as it goes (from a
+        # queue, for example) is read no faster than the requests complete and their results are handled
+        max_pending = self.max_concurrency * JOBS_PER_SLOT
+        room = asyncio.Semaphore(max_pending)
+        results = asyncio.Queue()
+        tasks = {}  # the key of each request in flight, by its task
+        async with client_manager.create_async_client(self.api_key, self.base_url, self.max_concurrency) as client:
+            reader = asyncio.create_task(self.read_jobs(iter(jobs), client, semaphore, room, max_pending, results,
+                                                        tasks, cancel_event))
+            watcher = None
+            if cancel_event is not None:
+                watcher = asyncio.create_task(self.watch_cancel(cancel_event, tasks))
+            try:
+                while True:
+                    result = await results.get()
+                    if result is None:
+                        break
+                    key, response, error = result
+                    try:
+                        # A slow handler must not stall the event loop, or the responses in flight would not be read
+                        # and their timeouts and retry delays would not run
+                        await asyncio.to_thread(on_result, key, response, error)
+                    except Exception as e:
+                        # A failure handling one result must not stop the others
+                        print(f"Error handling the response for {key}: {e}")
+                    room.release()
+                # Raises the error of the jobs iterator, if it failed
+                await reader
+            finally:
+                if watcher is not None:
+                    watcher.cancel()
+                for task in list(tasks):
+                    task.cancel()
+
+    async def read_jobs(self, jobs, client, semaphore, room, max_pending, results, tasks, cancel_event=None):
+        """
+        Start a request for each job as room is made for it, and put its (key, response, error) on results when it
+        completes. Puts None on results once the result of every job has been handled.
+        """
+        try:
+            while True:
+                await room.acquire()
+                # The next job may take a while to be produced, so it is waited for off the event loop
+                job = await asyncio.to_thread(next, jobs, None)
+                if job is None:
+                    room.release()
+                    break
+                key, request_body, prompt_tokens = job
+                if cancel_event is not None and cancel_event.is_set():
+                    results.put_nowait((key, None, asyncio.CancelledError("Cancelled")))
+                    continue
+                task = asyncio.create_task(self.send(client, semaphore, key, request_body, prompt_tokens))
+                tasks[task] = key
+                task.add_done_callback(lambda done: results.put_nowait(self.task_result(done, tasks.pop(done))))
+            # All the room is free again once every result has been handled
+            for _ in range(max_pending):
+                await room.acquire()
+        finally:
+            results.put_nowait(None)
+
+    @staticmethod
+    def task_result(task, key):
+        """Return the (key, response, error) of a completed send task."""
+        if task.cancelled():
+            return key, None, asyncio.CancelledError("Cancelled")
+        return task.result()
+
+    @staticmethod
+    async def watch_cancel(cancel_event, tasks):
+        """Cancel every task in flight once cancel_event is set."""
+        while not cancel_event.is_set():
+            await asyncio.sleep(CANCEL_POLL_INTERVAL)
+        print("Cancelling the requests that have not completed")
+        for task in list(tasks):
+            task.cancel()
+
+    async def send(self, client, semaphore, key, request_body, prompt_tokens=None):
+        """Send one request once a slot is free, retrying transient failures. Returns (key, response, error)."""
+        if self.response_cache is not None:
+            cache_key = request_key(request_body)
+            cached_response = self.response_cache.get(cache_key)
+            if cached_response is not None:
+                print(f"Replaying the cached response for {key}")
+                return key, cached_response, None
+        async with semaphore:
+            try:
+                response = await self.retry_policy.call_async(self.timed_attempt, client, request_body, prompt_tokens)
+                # Responses are handed on as dictionaries, in the same shape as the JSON the API returns
+                response = response.model_dump()
+                if self.response_cache is not None:
+                    self.response_cache.put(cache_key, response)
+                return key, response, None
+            except Exception as e:
+                print(f"Error while sending the request for {key} to OpenAI: {e}")
+                return key, None, e
+
+    async def timed_attempt(self, client, request_body, prompt_tokens=None):
+        """Send a request once, giving up with a TimeoutError after request_timeout seconds."""
+        if self.request_timeout is None:
+            return await self.attempt(client, request_body, prompt_tokens)
+        try:
+            return await asyncio.wait_for(self.attempt(client, request_body, prompt_tokens), self.request_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No response after {self.request_timeout:g} seconds") from None
+
+    async def attempt(self, client, request_body, prompt_tokens=None):
+        """Send a request once, when the rate limits allow it. Returns the completion."""
+        if self.rate_limiter is None:
+            return await client.chat.completions.create(**request_body)
+
+        reserved_tokens = estimate_request_tokens(request_body, prompt_tokens)
+        await self.rate_limiter.acquire(reserved_tokens)
+        try:
+            raw_response = await client.chat.completions.with_raw_response.create(**request_body)
+        except (Exception, asyncio.CancelledError) as e:
+            # A rejected or abandoned request uses no tokens, and a 429 response reports the limits that were hit
+            self.rate_limiter.update_from_headers(error_headers(e))
+            self.rate_limiter.reconcile(reserved_tokens, 0)
+            raise
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        response = raw_response.parse()
+        if response.usage is not None:
+            self.rate_limiter.reconcile(reserved_tokens, response.usage.total_tokens)
+        return response
@@ -0,0 +1,106 @@
+import time
+import queue
+import threading
+
+"""
+Work on a worker thread for the Tk GUIs.
+
+Tk may only be used from the thread that runs its main loop, and anything slow done on that thread freezes the window.
+A background task runs a function on a worker thread instead. The function reports progress through the task, which
+puts it on a thread-safe queue; the main thread polls the queue with after() and calls the progress, done and error
+callbacks, so the callbacks are free to update the UI.
+
+A task can be cancelled and can have a hard timeout. The function is told through task.cancel_event, which it should
+check between steps. Unless the task was cancelled with wait=True, the UI does not wait for the function to notice:
+the task ends at once with a TaskCancelled or TimeoutError, and whatever the function does afterwards is ignored.
+"""
+
+POLL_INTERVAL = 50  # milliseconds between checks of the queue
+HARD_REQUEST_TIMEOUT = 900.0  # seconds after which the GUIs give up on a request, however it is progressing
+
+
+class TaskCancelled(Exception):
+    """The error a background task ends with when it is cancelled."""
+
+
+class BackgroundTask:
+    """
+    Runs function(task) on a worker thread. on_progress(*args) is called for every task.report(*args) made by the
+    function, on_done(result) with what it returns and on_error(error) with what it raises, all on the Tk main thread.
+    timeout is the number of seconds after which the task ends with a TimeoutError, or None for no limit.
+    """
+
+    def __init__(self, root, function, on_progress=None, on_done=None, on_error=None, timeout=None,
+                 poll_interval=POLL_INTERVAL):
+        self.root = root
+        self.function = function
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.cancel_event = threading.Event()
+        self.updates = queue.Queue()
+        self.finished = False
+        self.deadline = None
+
+    def start(self):
+        """Start the function on a worker thread. Returns the task."""
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+        threading.Thread(target=self.run, daemon=True).start()
+        self.root.after(self.poll_interval, self.poll)
+        return self
+
+    def run(self):
+        try:
+            self.updates.put(("done", self.function(self)))
+        except Exception as e:
+            self.updates.put(("error", e))
+
+    def report(self, *args):
+        """Hand progress to on_progress on the main thread. Can be called from any thread."""
+        self.updates.put(("progress", args))
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def cancel(self, wait=False):
+        """
+        Ask the function to stop. With wait=True the task goes on until the function returns, so it can report what it
+        finished; otherwise the task ends at once with a TaskCancelled error.
+        """
+        self.cancel_event.set()
+        if not wait:
+            self.finish("error", TaskCancelled("Cancelled"))
+
+    def poll(self):
+        """Deliver what the worker has put on the queue since the last poll. Runs on the main thread."""
+        while not self.finished:
+            try:
+                kind, value = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "progress":
+                if self.on_progress is not None:
+                    self.on_progress(*value)
+            else:
+                self.finish(kind, value)
+        if self.finished:
+            return
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.cancel_event.set()
+            self.finish("error", TimeoutError(f"No result after {self.timeout:g} seconds"))
+            return
+        self.root.after(self.poll_interval, self.poll)
+
+    def finish(self, kind, value):
+        if self.finished:
+            return
+        self.finished = True
+        if kind == "done":
+            if self.on_done is not None:
+                self.on_done(value)
+        elif self.on_error is not None:
+            self.on_error(value)
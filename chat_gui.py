@@ -3,19 +3,28 @@ from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
 from tkinter import messagebox
 from tkinter import simpledialog
-import tiktoken
 import openai
-from openai import OpenAI
 import json
+import hashlib
 import textwrap
 import keyring.backends.macOS
 import keyring.backends.Windows
+from openai.types.chat import ChatCompletion
+from openai_client import client_manager, get_client
+from background_task import BackgroundTask, TaskCancelled, HARD_REQUEST_TIMEOUT
+from retry_policy import default_retry_policy
+from response_cache import request_key, get_response_cache
+from model_registry import registry
+from model_discovery import cached_model_ids, known_models, list_model_ids
+from token_engine import num_tokens_from_messages, num_tokens_from_message, num_tokens_from_value, get_encoding, \
+    REPLY_PRIMING_TOKENS, CONTEXT_WINDOWS, preload_encodings
 
 """
 To build this script into an executable, run the following command from the root directory of the project:
 pyinstaller --hidden-import=tiktoken_ext.openai_public --hidden-import=tiktoken_ext --onefile openai_chat_gui.py
 """
 API_KEY = ''
+MODEL_CHECK_POLL_INTERVAL = 100  # milliseconds between checks for the result of a model check
 
 
 def check_api_key(root, keychain_path=None):
@@ -29,6 +38,8 @@ def check_api_key(root, keychain_path=None):
         api_key = get_api_key(root, keychain_path)
     if api_key:
         API_KEY = api_key
+        # The shared client is only rebuilt when the key changes
+        client_manager.set_api_key(api_key)
     return api_key
 
 
@@ -77,7 +88,7 @@ def prompt_for_api_key(root):
 
 
 def is_valid_api_key_model(api_key, test_model):
-    client = OpenAI(api_key=api_key)
+    client = get_client(api_key)
     error_messages = []
     print("Validating API key by calling OpenAI API")
 
@@ -146,68 +157,11 @@ class CustomMessageBox(simpledialog.Dialog):
         self.destroy()
 
 
-# Function to determine the number of tokens in a message
-def num_tokens_from_messages(messages, model):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-4-1106-preview"
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-    }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}
-            . See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are
-             converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            if isinstance(value, str):
-                # Encode strings
-                num_tokens += len(encoding.encode(value))
-            elif isinstance(value, (int, float)):
-                # Convert numbers to strings
-                num_tokens += len(encoding.encode(str(value)))
-            elif isinstance(value, (list, dict)):
-                # Handle iterables separately
-                num_tokens += len(value)
-            else:
-                # For other types, try converting to string
-                try:
-                    str_value = str(value)
-                    num_tokens += len(encoding.encode(str_value))
-                except:
-                    print(f"Could not handle value: {value}")
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
-
-
 def send_request(model: object, messages: object, temperature: object, top_p: object, n: object, stream: object,
                  stop: object, max_tokens: object, presence_penalty: object, frequency_penalty: object,
-                 logit_bias: object, user: object) -> object:
+                 logit_bias: object, user: object, response_cache=None) -> object:
     """
+    :param response_cache: if given, a request sent before is answered from the cache, and new responses are stored
     :param user:
     :param frequency_penalty:
     :param presence_penalty:
@@ -221,7 +175,7 @@ def send_request(model: object, messages: object, temperature: object, top_p: ob
     :param model:
     :type logit_bias: object
     """
-    client = OpenAI(api_key=API_KEY)
+    client = get_client(API_KEY)
     # Create request dictionary
     request_body = {
         'model': model,
@@ -237,6 +191,9 @@ def send_request(model: object, messages: object, temperature: object, top_p: ob
         'logit_bias': logit_bias,
         'user': user
     }
+    if stream:
+        # Ask for the usage of the request in the last chunk of the stream
+        request_body['stream_options'] = {'include_usage': True}
 
     # Mock headers
     headers = {
@@ -253,15 +210,82 @@ def send_request(model: object, messages: object, temperature: object, top_p: ob
     # Print HTTP message
     print("HTTP Message: ", http_message)
 
-    response = client.chat.completions.create(**request_body)
+    if response_cache is not None:
+        cache_key = request_key(request_body)
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            # A replay is returned whole, even when the request asked for a stream
+            print("Replaying the cached response")
+            return ChatCompletion.model_validate(cached_response)
+
+    response = default_retry_policy.call(client.chat.completions.create, **request_body)
+    if stream:
+        # The chunks are read by the caller as they arrive
+        if response_cache is not None:
+            return cache_stream(response, response_cache, cache_key)
+        return response
 
     # Print formatted response
     response_dict = response.model_dump()
     print("Response:\n", json.dumps(response_dict, indent=4))
+    if response_cache is not None:
+        response_cache.put(cache_key, response_dict)
 
     return response
 
 
+def cache_stream(stream, response_cache, cache_key):
+    """Yields the chunks of stream, and stores the completion they make up in response_cache once they have all been
+    read. Closing it before the end closes stream, and nothing is stored. Neither is a stream that was cut short, with
+    a completion that has no finish reason."""
+    chunks = []
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+    except GeneratorExit:
+        stream.close()
+        raise
+    response = read_stream(chunks, lambda index, text: None)
+    if response["choices"] and all(choice["finish_reason"] for choice in response["choices"]):
+        response_cache.put(cache_key, response)
+    else:
+        # A replay of it could not be turned back into a completion
+        print("The stream ended before the completion was finished, so it is not cached")
+
+
+def read_stream(stream, on_text, cancel_event=None):
+    """
+    Reads a streamed chat completion, calling on_text(choice index, text) for each piece of content as it arrives.
+    Returns the completion put back together as a dictionary in the shape of a response that was not streamed. The
+    usage is None if the API did not send it. If cancel_event is set, the stream is closed and what has arrived so far
+    is returned.
+    """
+    response = {"id": None, "object": "chat.completion", "created": None, "model": None, "choices": [], "usage": None}
+    choices = {}
+    for chunk in stream:
+        if cancel_event is not None and cancel_event.is_set():
+            stream.close()
+            break
+        response["id"] = chunk.id
+        response["created"] = chunk.created
+        response["model"] = chunk.model
+        if getattr(chunk, "usage", None) is not None:
+            response["usage"] = chunk.usage.model_dump()
+        for choice in chunk.choices:
+            collected = choices.setdefault(choice.index, {"index": choice.index, "finish_reason": None,
+                                                          "message": {"role": "assistant", "content": ""}})
+            if choice.delta.role:
+                collected["message"]["role"] = choice.delta.role
+            if choice.delta.content:
+                collected["message"]["content"] += choice.delta.content
+                on_text(choice.index, choice.delta.content)
+            if choice.finish_reason:
+                collected["finish_reason"] = choice.finish_reason
+    response["choices"] = [choices[index] for index in sorted(choices)]
+    return response
+
+
 # The send_request function submits the prompt to the Chat Completion API - Original Request
 """
 def send_request(model: object, prompt: object, temperature: object, top_p: object, n: object, stream: object,
@@ -349,19 +373,10 @@ class PromptUI:
         self.prompt_structure_tab = tk.Frame(self.prompt_notebook)
         self.prompt_notebook.add(self.prompt_structure_tab, text=" Guide to Prompt Structure ")
 
-        prompt_structure_text = textwrap.dedent("""Context Window Size (in tokens):
-
-gpt-4-1106-preview: 128,000
-gpt-4: 8192
-gpt-4-0613: 8192
-gpt-4-0314: 8192
-gpt-4-32k: 32768
-gpt-4-32k-0613: 32768
-gpt-4-32k-0314: 32768
-gpt-3.5-turbo: 4096
-gpt-3.5-turbo-16k: 16384
-gpt-3.5-turbo-0613: 4096
-gpt-3.5-turbo-0301: 4096
+        # The context windows are listed from the model registry
+        context_window_list = "\n".join(f"{model}: {context_window:,}"
+                                         for model, context_window in self.context_windows.items())
+        prompt_structure_text = f"Context Window Size (in tokens):\n\n{context_window_list}" + textwrap.dedent("""
 
 Guide to Structuring a Chat Completion prompt for OpenAI LLMs
 
@@ -437,6 +452,11 @@ https://www.promptingguide.ai/
         self.model_menu.set("Select Model")  # default value
         self.model_menu.grid(row=0, column=1, padx=10, pady=5, sticky="w", columnspan=1)
 
+        # Model list status, while the available models are being checked in the background
+        self.model_status = tk.StringVar()
+        self.model_status_label = tk.Label(self.parameters_frame, textvariable=self.model_status, anchor="w")
+        self.model_status_label.grid(row=0, column=2, columnspan=4, padx=5, pady=5, sticky="w")
+
         # API Key
         self.api_key_entry = tk.Entry(self.parameters_frame, width=85)
         self.api_key_entry.grid(row=1, column=1, padx=5, columnspan=4)
@@ -487,7 +507,15 @@ https://www.promptingguide.ai/
                                "return.  If n is set to 3, the model will return three completions."
         ToolTip(self.n_label, n_label_tooltip_text)
 
-        # stream - not implemented
+        # stream
+        self.stream_var = tk.BooleanVar(value=True)
+        self.stream_checkbutton = tk.Checkbutton(self.parameters_frame, variable=self.stream_var)
+        self.stream_checkbutton.grid(row=6, column=2, padx=5, pady=5, sticky="w")
+        self.stream_label = tk.Label(self.parameters_frame, text="stream", width=16, anchor="w")
+        self.stream_label.grid(row=6, column=3, padx=5, pady=5, sticky="w")
+        stream_label_tooltip_text = "When stream is checked, the response is shown on the Response tab as it is\n" \
+                                    "generated instead of all at once when it is complete."
+        ToolTip(self.stream_label, stream_label_tooltip_text)
 
         # stop
         self.stop_entry = tk.Entry(self.parameters_frame, width=5)
@@ -569,6 +597,17 @@ https://www.promptingguide.ai/
                                   " organization submitted which prompts."
         ToolTip(self.user_label, user_label_tooltip_text)
 
+        # cache responses
+        self.cache_responses_var = tk.BooleanVar(value=False)
+        self.cache_responses_checkbutton = tk.Checkbutton(self.parameters_frame, variable=self.cache_responses_var)
+        self.cache_responses_checkbutton.grid(row=7, column=0, padx=10, pady=5, sticky="w")
+        self.cache_responses_label = tk.Label(self.parameters_frame, text="cache responses", width=16, anchor="w")
+        self.cache_responses_label.grid(row=7, column=1, padx=5, pady=5, sticky="w")
+        cache_responses_label_tooltip_text = "When cache responses is checked, every response is saved on disk, and\n" \
+                                             "a request that is exactly the same as one sent before gets the saved\n" \
+                                             "response back instantly, without calling the API or using any tokens."
+        ToolTip(self.cache_responses_label, cache_responses_label_tooltip_text)
+
         # Context length
         self.context_length = tk.IntVar()
         self.context_length.set(0)
@@ -605,7 +644,8 @@ https://www.promptingguide.ai/
         self.message_buttons_frame.columnconfigure(2, weight=0)  # Button 2
         self.message_buttons_frame.columnconfigure(3, weight=0)  # Button 3
         self.message_buttons_frame.columnconfigure(4, weight=0)  # Button 3
-        self.message_buttons_frame.columnconfigure(5, weight=1)  # Empty column on the right
+        self.message_buttons_frame.columnconfigure(5, weight=0)  # Button 4
+        self.message_buttons_frame.columnconfigure(6, weight=1)  # Empty column on the right
 
         # Buttons
         self.new_prompt_button = tk.Button(self.message_buttons_frame, text="Restore Defaults",
@@ -620,12 +660,23 @@ https://www.promptingguide.ai/
                                               command=self.submit_prompt)
         self.submit_prompt_button.grid(row=3, column=3, padx=5, pady=5)
 
-        self.submit_prompt_button = tk.Button(self.message_buttons_frame, text="Delete prompt",
+        self.delete_prompt_button = tk.Button(self.message_buttons_frame, text="Delete prompt",
                                               command=self.delete_prompt)
-        self.submit_prompt_button.grid(row=3, column=4, padx=5, pady=5)
+        self.delete_prompt_button.grid(row=3, column=4, padx=5, pady=5)
+
+        # The request in progress, which is sent from a worker thread so the window stays usable
+        self.request_task = None
+        self.cancel_request_button = tk.Button(self.message_buttons_frame, text="Cancel request",
+                                               command=self.cancel_request, state="disabled")
+        self.cancel_request_button.grid(row=3, column=5, padx=5, pady=5)
+        self.request_status = tk.StringVar()
+        self.request_status_label = tk.Label(self.message_buttons_frame, textvariable=self.request_status)
+        self.request_status_label.grid(row=4, column=1, columnspan=5, padx=5, pady=2)
 
         # Message components frame
         self.message_components = []
+        # Token count of each message component's content, keyed by (content hash, model)
+        self.component_token_counts = {}
 
         self.message_components_frame = tk.Frame(self.content_frame)
         self.message_components_frame.grid(row=5, column=0, columnspan=3, sticky="w")
@@ -652,17 +703,58 @@ https://www.promptingguide.ai/
         self.context_length.set(context_length)
 
     def refresh_model_list(self):
-        new_model_list = populate_model_list(self.context_windows, self.api_key)
-        print("Updating model list: " + str(new_model_list))
-        self.model_menu['values'] = ["Select Model"] + new_model_list
-        self.model_list = new_model_list
+        self.load_models_in_background(refresh=True)
+
+    def load_models_in_background(self, refresh=False):
+        """
+        Fills the model list without blocking the UI. The cached list of the API key is shown at once if there is one,
+        and the list is then checked with the API on a worker thread, unless the cached list is fresh. refresh checks
+        it with the API in any case.
+        """
+        # Pick up any change to the model registry file first
+        registry.reload_if_changed()
+        cached_ids = cached_model_ids(self.api_key)
+        if cached_ids is not None:
+            self.set_model_list(known_models(cached_ids, self.context_windows))
+        self.model_status.set("Checking the API key and the available models...")
+        # The check runs on a daemon thread, so a slow list call does not keep the application alive once it is closed
+        api_key = self.api_key
+        BackgroundTask(self.root, lambda task: list_model_ids(api_key, refresh=refresh),
+                       on_done=lambda model_ids: self.show_model_check(api_key, model_ids),
+                       on_error=lambda error: self.show_model_check(api_key, error=error),
+                       poll_interval=MODEL_CHECK_POLL_INTERVAL).start()
+
+    def show_model_check(self, api_key, model_ids=None, error=None):
+        """Shows the result of a model check started by load_models_in_background."""
+        if api_key != self.api_key:
+            # The API key was changed while its models were being checked
+            return
+        if error is not None:
+            print(f"Error while fetching the list of models: {error}")
+            self.model_status.set("Could not check the models. Check the API key and the connection.")
+            return
+        model_list = known_models(model_ids, self.context_windows)
+        self.set_model_list(model_list)
+        self.model_status.set(f"{len(model_list)} models available")
+
+    def set_model_list(self, model_list):
+        print("Updating model list: " + str(model_list))
+        self.model_menu['values'] = ["Select Model"] + model_list
+        self.model_list = model_list
 
     def edit_api_key(self):
         # Here is where you'd put the logic to edit the API Key
+        global API_KEY
         new_api_key = get_api_key(self.root)
         if new_api_key:
             self.api_key_entry.delete(0, 'end')
             self.api_key_entry.insert(0, new_api_key)
+            # Requests from now on use the new key, through a client built for it
+            API_KEY = new_api_key
+            self.api_key = new_api_key
+            openai.api_key = new_api_key
+            client_manager.set_api_key(new_api_key)
+            self.load_models_in_background()
 
     def validate_model(self):
 
@@ -674,7 +766,7 @@ https://www.promptingguide.ai/
         print("Validating model")
         model = self.model_var.get()
         if model == "Refresh Model List":
-            populate_model_list(self.context_windows, self.model_list)
+            self.refresh_model_list()
             return False
         if model not in self.model_list:
             messagebox.showerror("Error", "Invalid model. Please select a valid model.")
@@ -728,7 +820,29 @@ https://www.promptingguide.ai/
         self.message_components.append({'role': tk.StringVar(), 'content': content})
 
         # Include all the message components in the token count
-        self.token_count.set(num_tokens_from_messages(self.message_components, model=self.model_var.get()))
+        self.update_token_count()
+
+    def update_token_count(self):
+        """Set the token count to the total for all of the message components.
+
+        The token count of each component's content is cached by a hash of the content and the model, so only the
+        components that have changed since the last count are encoded again and the total is a sum of cached counts.
+        """
+        model = self.model_var.get()
+        content_token_counts = {}
+        total_tokens = REPLY_PRIMING_TOKENS
+        for item in self.message_components:
+            key = (hashlib.sha256(item['content'].encode("utf-8")).hexdigest(), model)
+            if key not in content_token_counts:
+                content_token_counts[key] = self.component_token_counts.get(key)
+                if content_token_counts[key] is None:
+                    content_token_counts[key] = num_tokens_from_value(item['content'], get_encoding(model))
+            # The role is short, so it is counted along with the per-message overhead every time
+            total_tokens += num_tokens_from_message({'role': item['role'].get()}, model) + content_token_counts[key]
+
+        # Only the counts for the current components are kept
+        self.component_token_counts = content_token_counts
+        self.token_count.set(total_tokens)
 
     # Method to update the message component list in the main window
     def update_message_component_list(self):
@@ -801,7 +915,7 @@ https://www.promptingguide.ai/
             self.update_message_component_list()
 
             # Include all the message components in the token count
-            self.token_count.set(num_tokens_from_messages(self.message_components, model=self.model_var.get()))
+            self.update_token_count()
 
             message_component_window.destroy()
         print(f"Editing message component")
@@ -921,13 +1035,13 @@ https://www.promptingguide.ai/
             else:
                 return
 
-        # Set the stream to False
+        # Get the stream value
         """
         Optional. Stream is a boolean that defaults to false. If set, partial message deltas will be sent, like in
         ChatGPT. Tokens will be sent as data-only server-sent events as they become available, with the stream
         terminated by a data: [DONE] message.
         """
-        stream = False  # self.stream_entry.get()
+        stream = self.stream_var.get()
 
         # Validate stop
         """
@@ -964,7 +1078,7 @@ https://www.promptingguide.ai/
                 max_tokens = None
             else:
                 max_tokens = int(max_tokens_str)
-                if max_tokens < 1 or max_tokens > self.context_windows:
+                if max_tokens < 1 or max_tokens > registry.max_output_tokens(model):
                     raise ValueError("Invalid max_tokens value")
         except ValueError:
             message_box = CustomMessageBox(
@@ -1066,11 +1180,21 @@ https://www.promptingguide.ai/
         # (model, prompt, temperature, top_p, n, stop, max_tokens, presence_penalty, frequency_penalty, logit_bias,
         #  user)
         print("Parameters validated. Sending request...")
-        response = send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
-                                frequency_penalty, logit_bias, user)
-        print(f"Response type is: ", type(response))
-        print(response.usage.__dict__)
-        self.display_response(response)
+        if stream:
+            self.stream_response((model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
+                                  frequency_penalty, logit_bias, user), total_tokens)
+            return
+        request_args = (model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
+                        frequency_penalty, logit_bias, user)
+        response_cache = self.active_response_cache()
+
+        def show_response(response):
+            print(f"Response type is: ", type(response))
+            print(response.usage.__dict__)
+            self.display_response(response)
+
+        self.start_request(lambda task: send_request(*request_args, response_cache=response_cache),
+                           on_done=show_response)
 
     def reset_prompt_gui(self):
         print(
@@ -1088,6 +1212,7 @@ https://www.promptingguide.ai/
         self.top_p_entry.insert(0, "1.0")
         self.n_entry.delete(0, tk.END)
         self.n_entry.insert(0, "1")
+        self.stream_var.set(True)
         self.stop_entry.delete(0, tk.END)
         self.max_tokens_entry.delete(0, tk.END)
         self.presence_penalty_entry.delete(0, tk.END)
@@ -1117,8 +1242,105 @@ https://www.promptingguide.ai/
         response_text.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
 
         # Reset token count
+        self.component_token_counts.clear()
         self.token_count.set(0)
 
+    def start_request(self, function, on_progress=None, on_done=None):
+        """
+        Runs function(task) on a worker thread, so the window stays usable while a request is sent. The Submit button
+        is disabled and the Cancel request button enabled until it ends, and a request still running after
+        HARD_REQUEST_TIMEOUT seconds is given up on. on_progress and on_done are called on the UI thread.
+        """
+        def finish():
+            self.request_task = None
+            self.submit_prompt_button.configure(state="normal")
+            self.cancel_request_button.configure(state="disabled")
+
+        def done(result):
+            finish()
+            self.request_status.set("")
+            on_done(result)
+
+        def failed(error):
+            finish()
+            if isinstance(error, TaskCancelled):
+                self.request_status.set("Request cancelled")
+                return
+            self.request_status.set("")
+            print(f"Error while sending the request: {error}")
+            messagebox.showerror("Error", f"The request failed: {error}")
+
+        self.submit_prompt_button.configure(state="disabled")
+        self.cancel_request_button.configure(state="normal")
+        self.request_status.set("Waiting for the response...")
+        self.request_task = BackgroundTask(self.root, function, on_progress=on_progress, on_done=done, on_error=failed,
+                                           timeout=HARD_REQUEST_TIMEOUT).start()
+
+    def cancel_request(self):
+        if self.request_task is not None:
+            print("Cancelling the request")
+            self.request_task.cancel()
+
+    def stream_response(self, request_args, prompt_tokens):
+        """
+        Sends a request with stream on and shows the response on the Response tab as it is generated. The stream is
+        read on a worker thread, which hands the text to the UI thread through a background task.
+        request_args are the arguments of send_request, and prompt_tokens is the token count of the prompt.
+        """
+        model, n = request_args[0], request_args[4]
+
+        # Show a section for each completion, with a mark where its text is to be appended
+        for widget in self.results_tab.winfo_children():
+            widget.destroy()
+        response_text = ScrolledText(self.results_tab, wrap=tk.WORD)
+        for i in range(n):
+            response_text.insert(tk.END, f"Response {i + 1}:\n\"\"\n\n")
+            response_text.mark_set(f"choice{i}", "end-4c")
+        response_text.configure(state='disabled')
+        response_text.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
+        self.prompt_notebook.select(self.results_tab)
+
+        response_cache = self.active_response_cache()
+
+        def read_response(task):
+            stream = send_request(*request_args, response_cache=response_cache)
+            if isinstance(stream, ChatCompletion):
+                # Replayed from the response cache
+                return stream.model_dump()
+            return read_stream(stream, task.report, task.cancel_event)
+
+        def show_text(index, text):
+            response_text.configure(state='normal')
+            response_text.insert(f"choice{index}", text)
+            response_text.configure(state='disabled')
+            response_text.see(f"choice{index}")
+
+        def show_response(response):
+            if response["usage"] is None:
+                # The API did not report the usage, so count it
+                encoding = get_encoding(model)
+                completion_tokens = sum(num_tokens_from_value(choice["message"]["content"], encoding)
+                                        for choice in response["choices"])
+                response["usage"] = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                                     "total_tokens": prompt_tokens + completion_tokens}
+            print("Response:\n", json.dumps(response, indent=4))
+            try:
+                completion = ChatCompletion.model_validate(response)
+            except ValueError as e:
+                # pydantic's ValidationError is a ValueError. A stream that was cut short has no finish reason, for
+                # example; the text that did arrive stays on the Response tab.
+                print(f"Error while reading the streamed response: {e}")
+                messagebox.showerror("Error", "The response ended before it was complete, so it cannot be shown in "
+                                              "full. The text that arrived is on the Response tab.")
+                return
+            self.display_response(completion)
+
+        self.start_request(read_response, on_progress=show_text, on_done=show_response)
+
+    def active_response_cache(self):
+        """Return the response cache if cache responses is checked, otherwise None."""
+        return get_response_cache() if self.cache_responses_var.get() else None
+
     def display_response(self, response):
         print("Response received. Displaying response...")
         for widget in self.results_tab.winfo_children():
@@ -1169,54 +1391,14 @@ https://www.promptingguide.ai/
         response_text.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
 
 
-def populate_model_list(context_window, api_key):
-    """Iterates through the set of models in the context_window global variable and tries an api call for that model
-     using the is_valid_api_key_model function. If the API call is successful, adds the model name to the model_list,
-     otherwise proceeds to the next model in the context_window list. When all models have been tested, returns the
-     model_list.
-
-  Args:
-    api_key: The OpenAI API key to use for the API calls.
-    context_window: A dictionary of model names and context window sizes.
-
-  Returns:
-    A list of the model names that are valid for the provided API key.
-  """
-    # TODO: Dynamically generate the context_window dictionary from JSON returned from this API call:
-    # models = openai.Model.list()
-    # for model in models['data']:
-    #     print(model['id'])
-    #
-    # or somewhere like this:
-    # https://github.com/terminalcommandnewsletter/everything-chatgpt
-
-    model_list = []
-    for model_name, context_window in context_window.items():
-        print(f"Testing {model_name}...")
-        if not is_valid_api_key_model(api_key, model_name):
-            model_list.append(model_name)
-
-    return model_list
-
-
 if __name__ == "__main__":
-    context_windows = {
-        "gpt-4-1106-preview": 128000,
-        "gpt-4": 8192,
-        "gpt-4-0613": 8192,
-        "gpt-4-0314": 8192,
-        "gpt-4-32k": 32768,
-        "gpt-4-32k-0613": 32768,
-        "gpt-4-32k-0314": 32768,
-        "gpt-3.5-turbo": 4096,
-        "gpt-3.5-turbo-16k": 16384,
-        "gpt-3.5-turbo-0613": 4096,
-        "gpt-3.5-turbo-0301": 4096,
-        "gpt-3.5-turbo-16k-0613": 16384
-    }
+    context_windows = CONTEXT_WINDOWS
+    # Load the tokenizer while the API key is checked and the UI is built
+    preload_encodings(context_windows)
     api_key = None
     app_root = tk.Tk()
     openai.api_key = check_api_key(app_root, api_key)
-    model_list = populate_model_list(context_windows, openai.api_key)
-    app = PromptUI(app_root, model_list, context_windows, openai.api_key)
+    # The window is shown at once, and the model list is filled in as the available models are checked
+    app = PromptUI(app_root, [], context_windows, openai.api_key)
+    app.load_models_in_background()
     app_root.mainloop()
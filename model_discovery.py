@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import hashlib
+from token_engine import CACHE_DIR
+
+"""
+Discovery of the models an API key can use.
+
+The models available to a key are fetched with a single call to the list-models endpoint and joined with the
+context-window table, so the GUIs offer only the chat models they know the context window of. The list is cached on
+disk for MODEL_LIST_TTL seconds per API key (the key itself is not stored, only its hash), so a start with a fresh cache
+makes no network call at all.
+"""
+
+MODEL_LIST_CACHE_PATH = os.path.join(CACHE_DIR, "models.json")
+MODEL_LIST_TTL = 24 * 60 * 60  # seconds a fetched model list is used before it is fetched again
+
+
+def api_key_hash(api_key):
+    """Return the name an API key's model list is cached under."""
+    return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()
+
+
+def load_model_list_cache(path=MODEL_LIST_CACHE_PATH):
+    """Return the cached model lists, by API key hash. A missing or unreadable cache is treated as empty."""
+    try:
+        with open(path, "r", encoding="utf-8") as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_model_list_cache(cache, path=MODEL_LIST_CACHE_PATH):
+    """Write the cached model lists, replacing the file in one step so that a reader never sees half of it."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(temporary_path, path)
+
+
+def fetch_model_ids(api_key):
+    """Return the IDs of every model available to api_key, with one call to the list-models endpoint."""
+    # The OpenAI library is only imported when the list has to be fetched
+    from openai_client import get_client
+    print("Fetching the list of available models")
+    return sorted(model.id for model in get_client(api_key).models.list())
+
+
+def cached_model_ids(api_key, path=MODEL_LIST_CACHE_PATH):
+    """Return the cached IDs of the models available to api_key, however old, or None if there are none. Makes no
+    network call."""
+    cached = load_model_list_cache(path).get(api_key_hash(api_key))
+    return cached["models"] if cached else None
+
+
+def known_models(model_ids, context_windows):
+    """Return the models in context_windows that are among model_ids, in the order of context_windows."""
+    model_ids = set(model_ids)
+    return [model_name for model_name in context_windows if model_name in model_ids]
+
+
+def list_model_ids(api_key, ttl=MODEL_LIST_TTL, refresh=False, path=MODEL_LIST_CACHE_PATH):
+    """
+    Return the IDs of the models available to api_key, from the cache if it was fetched less than ttl seconds ago, and
+    from the API otherwise or if refresh is True. If the API cannot be reached, an expired list is used rather than
+    none. Raises the API error if there is no list to fall back on.
+    """
+    cache = load_model_list_cache(path)
+    cached = cache.get(api_key_hash(api_key))
+    if cached and not refresh and time.time() - cached["fetched"] < ttl:
+        print("Using the cached list of available models")
+        return cached["models"]
+
+    try:
+        model_ids = fetch_model_ids(api_key)
+    except Exception as e:
+        if cached:
+            print(f"Could not fetch the list of models ({e}), using the list from "
+                  f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(cached['fetched']))}")
+            return cached["models"]
+        raise
+
+    cache[api_key_hash(api_key)] = {"fetched": time.time(), "models": model_ids}
+    try:
+        save_model_list_cache(cache, path)
+    except OSError as e:
+        print(f"Could not save the list of models: {e}")
+    return model_ids
+
+
+def available_models(api_key, context_windows, refresh=False):
+    """
+    Return the models in context_windows that are available to api_key, in the order of context_windows. Returns an
+    empty list if the available models cannot be determined.
+    """
+    try:
+        model_ids = list_model_ids(api_key, refresh=refresh)
+    except Exception as e:
+        print(f"Error while fetching the list of models: {e}")
+        return []
+    return known_models(model_ids, context_windows)
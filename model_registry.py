@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import threading
+
+"""
+The model capability registry.
+
+Everything the tools know about a model (its context window, the most tokens it can generate, its tokenizer, the tokens
+the API adds per message and per name, and its prices) is described in one JSON file, resources/models.json. A
+different file can be used by setting LLM_TOOLS_MODEL_REGISTRY to its path. The file is read once and kept in memory as
+plain dictionaries for fast lookups, and can be read again without restarting: reload_if_changed() reloads it when it
+has been modified since it was last read.
+
+The dictionaries are updated in place when the registry is reloaded, so any code holding one of them, such as the
+context-window table a GUI was built with, sees the new values.
+
+Registry format:
+    {
+        "families": {"<model family>": "<model whose message overheads are used for unknown models of the family>"},
+        "models": {
+            "<model>": {"context_window": 8192, "max_output_tokens": 8192, "tokenizer": "cl100k_base",
+                        "tokens_per_message": 3, "tokens_per_name": 1, "prompt_price": 0.03, "completion_price": 0.06}
+        }
+    }
+Prices are in US dollars per 1,000 tokens. Only context_window is required.
+"""
+
+BUNDLED_REGISTRY_PATH = os.path.join(getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__))),
+                                     "resources", "models.json")
+REGISTRY_PATH = os.environ.get("LLM_TOOLS_MODEL_REGISTRY") or BUNDLED_REGISTRY_PATH
+
+# Values used for a model whose entry leaves them out
+MODEL_DEFAULTS = {"tokenizer": "cl100k_base", "tokens_per_message": 3, "tokens_per_name": 1}
+
+
+class ModelRegistry:
+    """
+    The models described in a registry file. The registry can be shared between threads.
+    """
+
+    def __init__(self, path=REGISTRY_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.modified = None
+        self.reload_callbacks = []
+        # Lookup tables, filled by reload
+        self.models = {}  # model: its complete entry
+        self.context_windows = {}  # model: context window in tokens
+        self.message_rules = {}  # model: {"tokens_per_message": ..., "tokens_per_name": ...}
+        self.prices = {}  # model: {"prompt": ..., "completion": ...} in US dollars per 1,000 tokens
+        self.families = {}  # model family: model its unknown members are counted as
+        self.reload()
+
+    def reload(self):
+        """
+        Read the registry file again. Returns True if it was loaded. If the file cannot be read or is invalid, the
+        models loaded before are kept (there are none the first time, so the error is raised).
+        """
+        with self.lock:
+            modified = None
+            try:
+                modified = os.path.getmtime(self.path)
+                with open(self.path, "r", encoding="utf-8") as registry_file:
+                    registry = json.load(registry_file)
+                models = {}
+                for model, entry in registry["models"].items():
+                    if not isinstance(entry.get("context_window"), int):
+                        raise ValueError(f"{model} has no context_window")
+                    models[model] = {**MODEL_DEFAULTS, **entry}
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                if self.modified is None:
+                    raise
+                print(f"Warning: could not reload the model registry {self.path}, keeping the models loaded before: "
+                      f"{e}")
+                # Not tried again until the file changes
+                self.modified = modified or self.modified
+                return False
+
+            self.replace(self.models, models)
+            self.replace(self.context_windows, {model: entry["context_window"] for model, entry in models.items()})
+            self.replace(self.message_rules, {model: {"tokens_per_message": entry["tokens_per_message"],
+                                                      "tokens_per_name": entry["tokens_per_name"]}
+                                              for model, entry in models.items()})
+            self.replace(self.prices, {model: {"prompt": entry["prompt_price"], "completion": entry["completion_price"]}
+                                       for model, entry in models.items()
+                                       if "prompt_price" in entry and "completion_price" in entry})
+            self.replace(self.families, registry.get("families", {}))
+            self.modified = modified
+            print(f"Loaded {len(models)} models from the model registry {self.path}")
+
+        for callback in self.reload_callbacks:
+            callback()
+        return True
+
+    @staticmethod
+    def replace(table, values):
+        table.clear()
+        table.update(values)
+
+    def reload_if_changed(self):
+        """Reload the registry if its file has been modified since it was read. Returns True if it was reloaded."""
+        try:
+            modified = os.path.getmtime(self.path)
+        except OSError:
+            return False
+        if modified == self.modified:
+            return False
+        return self.reload()
+
+    def on_reload(self, callback):
+        """Call callback() every time the registry is reloaded, to drop anything derived from the old entries."""
+        self.reload_callbacks.append(callback)
+
+    def get(self, model):
+        """Return the entry of model, or None if it is not in the registry."""
+        return self.models.get(model)
+
+    def context_window(self, model):
+        return self.models[model]["context_window"]
+
+    def max_output_tokens(self, model):
+        """Return the most tokens model can generate in one response."""
+        entry = self.models[model]
+        return entry.get("max_output_tokens", entry["context_window"])
+
+    def tokenizer(self, model):
+        """Return the name of the tiktoken encoding of model."""
+        return self.models[model]["tokenizer"]
+
+    def cost(self, model, prompt_tokens, completion_tokens=0):
+        """Return the price in US dollars of a request to model, or None if the price of model is not known."""
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return (prompt_tokens * price["prompt"] + completion_tokens * price["completion"]) / 1000
+
+
+registry = ModelRegistry()
@@ -3,12 +3,21 @@
 
 block_cipher = None
 
+import os
+
+# The tokenizer files are shipped with the app so it never has to download them. They are kept in the repository in
+# resources/tiktoken, under the names tiktoken caches them by ("python token_engine.py" fetches them again, for example
+# after a new encoding is added). The model registry is shipped with it as well.
+if not os.path.isdir('resources/tiktoken') or not os.listdir('resources/tiktoken'):
+    raise SystemExit('The tokenizer files are missing from resources/tiktoken. Restore them from the repository, or '
+                     'fetch them with "python token_engine.py" on a machine with network access.')
+
 
 a = Analysis(
     ['openai_chat_gui.py'],
     pathex=[],
     binaries=[],
-    datas=[],
+    datas=[('resources/tiktoken', 'resources/tiktoken'), ('resources/models.json', 'resources')],
     hiddenimports=['tiktoken_ext.openai_public', 'tiktoken_ext'],
     hookspath=[],
     hooksconfig={},
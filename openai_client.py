@@ -0,0 +1,84 @@
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+"""
+Process-wide OpenAI clients.
+
+Creating an OpenAI client creates a new HTTP connection pool, so a client made for every request has to open a new
+connection and redo the TLS handshake each time. The client manager keeps one configured client per API key and base
+URL for the life of the process, with keep-alive connections, pool limits and timeouts, and only builds a new one when
+the API key changes.
+"""
+
+MAX_CONNECTIONS = 20  # connections open at once, per client
+MAX_KEEPALIVE_CONNECTIONS = 10  # idle connections kept open for reuse
+KEEPALIVE_EXPIRY = 60.0  # seconds an idle connection is kept open
+CONNECT_TIMEOUT = 10.0  # seconds to open a connection
+REQUEST_TIMEOUT = 600.0  # seconds to wait for a response, long completions can take minutes
+MAX_RETRIES = 0  # retries made by the OpenAI library itself, off because retry_policy.py retries failed requests
+
+
+class ClientManager:
+    """
+    Keeps one OpenAI client per (API key, base URL). The clients can be shared between threads.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry=KEEPALIVE_EXPIRY, connect_timeout=CONNECT_TIMEOUT, request_timeout=REQUEST_TIMEOUT,
+                 max_retries=MAX_RETRIES):
+        self.limits = httpx.Limits(max_connections=max_connections,
+                                   max_keepalive_connections=max_keepalive_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.timeout = httpx.Timeout(request_timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get_client(self, api_key, base_url=None):
+        """Return the client for api_key and base_url (the OpenAI API by default), creating it on first use."""
+        with self.lock:
+            client = self.clients.get((api_key, base_url))
+            if client is None:
+                print(f"Creating an OpenAI client for {base_url or 'the OpenAI API'}")
+                client = OpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout, max_retries=self.max_retries,
+                                http_client=httpx.Client(limits=self.limits, timeout=self.timeout))
+                self.clients[(api_key, base_url)] = client
+            return client
+
+    def set_api_key(self, api_key, base_url=None):
+        """
+        Make api_key the key in use for base_url. The clients of any other keys for base_url are closed, and the client
+        for api_key is kept if it already exists. Returns the client.
+        """
+        with self.lock:
+            for key in [key for key in self.clients if key[1] == base_url and key[0] != api_key]:
+                self.clients.pop(key).close()
+        return self.get_client(api_key, base_url)
+
+    def create_async_client(self, api_key, base_url=None, max_connections=MAX_CONNECTIONS):
+        """
+        Return a new AsyncOpenAI client with room for max_connections requests at once. Async connections belong to the
+        event loop they were opened in, so async clients are not shared; use one per run, as an async context manager so
+        its connections are closed at the end.
+        """
+        limits = httpx.Limits(max_connections=max_connections,
+                              max_keepalive_connections=max_connections,
+                              keepalive_expiry=self.limits.keepalive_expiry)
+        return AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=self.timeout, max_retries=self.max_retries,
+                           http_client=httpx.AsyncClient(limits=limits, timeout=self.timeout))
+
+    def close(self):
+        """Close every client and its connections."""
+        with self.lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
+
+
+client_manager = ClientManager()
+
+
+def get_client(api_key, base_url=None):
+    """Return the shared client for api_key and base_url."""
+    return client_manager.get_client(api_key, base_url)
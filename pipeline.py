@@ -0,0 +1,142 @@
+import queue
+import threading
+
+"""
+Staged pipelines of worker threads.
+
+A pipeline passes items through a series of stages. Each stage is run by its own worker threads and is connected to the
+next by a bounded queue, so every stage works on a different item at the same time: reading files, for example, goes on
+while earlier items wait for the network and later ones are being saved. When a stage falls behind, its input queue
+fills up and the stages before it wait for room instead of piling up items in memory.
+
+A stage is either a function of one item, run by any number of workers, that returns the item to pass on (or None to
+drop it), or a stream stage: a function run by one thread that takes an iterator over the stage's input and a function
+to pass items on with, which lets a stage like the request engine keep several items in flight at once.
+
+If a stage raises an exception, the whole pipeline is stopped and run() raises it. Errors that should only fail one
+item have to be handled by the stage itself.
+"""
+
+QUEUE_SIZE = 16  # items waiting between two stages
+WAIT_INTERVAL = 0.1  # seconds between checks that the pipeline has not been stopped, while waiting on a queue
+
+END = object()  # put on a queue after its last item
+
+
+class Pipeline:
+    """
+    Stages connected by queues of at most queue_size items. Add the stages in order with add_stage and
+    add_stream_stage, then call run.
+    """
+
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stages = []  # (name, function, number of workers, whether it is a stream stage)
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.error = None
+
+    def add_stage(self, name, function, workers=1):
+        """Add a stage that calls function(item) for each item, on workers threads. Returns the pipeline."""
+        if workers < 1:
+            raise ValueError("A stage needs at least one worker.")
+        self.stages.append((name, function, workers, False))
+        return self
+
+    def add_stream_stage(self, name, function):
+        """Add a stage that calls function(items, pass_on) once, on one thread, to handle every item. Returns the
+        pipeline."""
+        self.stages.append((name, function, 1, True))
+        return self
+
+    def run(self, items):
+        """
+        Pass every item of items through the stages, and block until they have all gone through or been dropped.
+        What the last stage returns is discarded. Raises the first exception raised by a stage.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]  # the input queue of each stage
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True)]
+        for index, (name, function, workers, stream) in enumerate(self.stages):
+            output_queue = queues[index + 1] if index + 1 < len(queues) else None
+            running = [workers]  # workers of the stage that have not finished, shared between them
+            for _ in range(workers):
+                threads.append(threading.Thread(
+                    target=self.work, args=(name, function, stream, queues[index], output_queue, running),
+                    daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self, error=None):
+        """Stop every stage. The pipeline raises error, if one is given."""
+        with self.lock:
+            if error is not None and self.error is None:
+                self.error = error
+        self.stop_event.set()
+
+    def put(self, item_queue, item):
+        """Put item on item_queue, waiting for room. Returns False if the pipeline was stopped in the meantime."""
+        while not self.stop_event.is_set():
+            try:
+                item_queue.put(item, timeout=WAIT_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, item_queue):
+        """Take the next item from item_queue, or END once the pipeline has been stopped."""
+        while not self.stop_event.is_set():
+            try:
+                return item_queue.get(timeout=WAIT_INTERVAL)
+            except queue.Empty:
+                pass
+        return END
+
+    def iterate(self, item_queue):
+        """Yield the items of item_queue until its end."""
+        while True:
+            item = self.get(item_queue)
+            if item is END:
+                # Leave the end for the other workers of the stage
+                self.put(item_queue, END)
+                return
+            yield item
+
+    def feed(self, items, first_queue):
+        try:
+            for item in items:
+                if not self.put(first_queue, item):
+                    break
+        except Exception as e:
+            print(f"Error reading the items of the pipeline: {e}")
+            self.stop(e)
+        finally:
+            self.put(first_queue, END)
+
+    def work(self, name, function, stream, input_queue, output_queue, running):
+        def pass_on(item):
+            if output_queue is not None:
+                self.put(output_queue, item)
+
+        try:
+            if stream:
+                function(self.iterate(input_queue), pass_on)
+            else:
+                for item in self.iterate(input_queue):
+                    result = function(item)
+                    if result is not None:
+                        pass_on(result)
+        except Exception as e:
+            print(f"Error in the {name} stage of the pipeline: {e}")
+            self.stop(e)
+        finally:
+            with self.lock:
+                running[0] -= 1
+                last = running[0] == 0
+            # The end is passed on once every worker of the stage is done with its items
+            if last and output_queue is not None:
+                self.put(output_queue, END)
@@ -5,32 +5,50 @@ from tkinter import ttk
 from tkinter.scrolledtext import ScrolledText
 from tkinter import messagebox
 from tkinter import simpledialog
-import tiktoken
-import openai
 import json
+import sqlite3
 import textwrap
 import keyring.backends.macOS
 import keyring.backends.Windows
-from jsonschema import validate, ValidationError
+from token_engine import num_tokens_from_messages, TokenCountCache, PromptTemplate, CONTEXT_WINDOWS, \
+    preload_encodings
+from rate_limiter import RateLimiter, DEFAULT_REQUESTS_PER_MINUTE, DEFAULT_TOKENS_PER_MINUTE
+from retry_policy import RetryPolicy, default_retry_policy
+from response_cache import request_key, get_response_cache
+from model_registry import registry
+from model_discovery import cached_model_ids, known_models, list_model_ids
+from background_task import BackgroundTask, TaskCancelled, HARD_REQUEST_TIMEOUT
+from pipeline import Pipeline
 import datetime
-import pandas as pd
-from openpyxl import load_workbook
-import chardet
+
+# openai, jsonschema, chardet, pandas and openpyxl take a long time to import and are not needed to show the UI, so
+# they are imported in the functions that use them. startup_benchmark.py checks that they stay out of the startup path.
 
 """
 To build this script into an executable, run the following command from the root directory of the project:
 pyinstaller --hidden-import=tiktoken_ext.openai_public --hidden-import=tiktoken_ext --onefile openai_chat_gui.py
 """
 
+DEFAULT_TEST_CONCURRENCY = 8  # prompts sent at once in a test run
+MODEL_CHECK_POLL_INTERVAL = 100  # milliseconds between checks for the result of a model check
+TEST_LOAD_WORKERS = 4  # source files read and decoded at once in a test run
+TEST_COUNT_BATCH_SIZE = 64  # source files whose prompts are counted together, before a test run sends any
+TEST_RUN_MAX_RETRIES = 100  # retries of failed prompts allowed in one test run, before the remaining failures are kept
+API_KEY = ''
+
 
 def check_api_key(root, keychain_path=None):
     # Attempt to retrieve the API key from the keyring
     print("Attempting to retrieve API Key from keyring")
+    global API_KEY
     api_key = keyring.get_password("openai", "api_key")
     if not api_key:
         # Open a Tkinter dialogue to prompt the user for their OpenAI API Key
         print("API Key not retrieved from keyring. Prompting user for API Key")
         api_key = get_api_key(root, keychain_path)
+    if api_key:
+        # The key is kept here rather than in openai.api_key, so reading it does not import openai
+        API_KEY = api_key
     return api_key
 
 
@@ -79,18 +97,20 @@ def prompt_for_api_key(root):
 
 
 def is_valid_api_key_model(api_key, test_model):
-    openai.api_key = api_key
+    import openai
+    from openai_client import get_client
+    client = get_client(api_key)
     error_messages = []
     print("Validating API key by calling OpenAI API")
     try:
-        response = openai.ChatCompletion.create(
+        response = client.chat.completions.create(
             model=test_model,
             messages=[{"role": "user", "content": "Hello, world!"}],
             temperature=0.9, top_p=1, n=1, stream=False, max_tokens=5,
             presence_penalty=0, frequency_penalty=0, logit_bias={}, user=""
         )
         print("This API key/model combination is valid. Model Response:")
-        print(response['choices'][0]['message']['content'])
+        print(response.choices[0].message.content)
     except openai.OpenAIError as e:
         print(f"Error: {e}")
         error_messages.append(str(e))
@@ -139,67 +159,12 @@ class CustomMessageBox(simpledialog.Dialog):
         self.destroy()
 
 
-# Function to determine the number of tokens in a message
-def num_tokens_from_messages(messages, model):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-    }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}
-            . See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are
-             converted to tokens."""
-        )
-
-    # num_tokens += len(encoding.encode(message, disallowed_special=()))
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            if isinstance(value, str):
-                # Encode strings
-                num_tokens += len(encoding.encode(value, disallowed_special=()))
-            elif isinstance(value, (int, float)):
-                # Convert numbers to strings
-                num_tokens += len(encoding.encode(str(value)))
-            elif isinstance(value, (list, dict)):
-                # Handle iterables separately
-                num_tokens += len(value)
-            else:
-                # For other types, try converting to string
-                try:
-                    str_value = str(value)
-                    num_tokens += len(encoding.encode(str_value, disallowed_special=()))
-                except:
-                    print(f"Could not handle value: {value}")
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
-
-
 def send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty, frequency_penalty,
-                 logit_bias, user):
+                 logit_bias, user, response_cache=None):
+    """
+    Sends a chat completion request and returns the response, or None if it failed. If response_cache is given, a
+    request that was sent before is answered from the cache, and new responses are stored in it.
+    """
 
     def extract_string_var(value, name):
         """Helper function to extract string value if the input is a StringVar."""
@@ -266,13 +231,37 @@ def send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens,
 
     print("Sending request to OpenAI in send_request function...")
 
+    import openai
+    from openai_client import get_client
+    if response_cache is not None:
+        cache_key = request_key(payload)
+        cached_response = response_cache.get(cache_key)
+        if cached_response is not None:
+            print("Replaying the cached response")
+            from openai.types.chat import ChatCompletion
+            return ChatCompletion.model_validate(cached_response)
+
     try:
-        response = openai.ChatCompletion.create(**payload)
+        response = default_retry_policy.call(get_client(API_KEY).chat.completions.create, **payload)
+        if response_cache is not None:
+            response_cache.put(cache_key, response.model_dump())
         return response
     except openai.OpenAIError as e:
         print(f"Error while sending request to OpenAI: {e}")
         return None
 
+
+def build_request_body(request):
+    """
+    Turns a request in the form of the arguments of send_request into the body of a chat completion request. Optional
+    parameters that were left empty are not sent.
+    """
+    request_body = {"messages": request["prompt"]}
+    for key, value in request.items():
+        if key != "prompt" and value is not None and value != "" and value != [] and value != {}:
+            request_body[key] = value
+    return request_body
+
 """
 def send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty, frequency_penalty, logit_bias, user):
 
@@ -373,6 +362,7 @@ class PromptUI:
         self.api_key = api_key
         self.context_windows = context_windows
         self.context_length = tk.IntVar()
+        self.token_count_cache = None  # opened on the first test run
         self.root.title("Chat Completion API UI")
         self.root.geometry("700x800")
 
@@ -391,18 +381,10 @@ class PromptUI:
         self.prompt_structure_tab = tk.Frame(self.prompt_notebook)
         self.prompt_notebook.add(self.prompt_structure_tab, text=" Guide to Prompt Structure ")
 
-        prompt_structure_text = textwrap.dedent("""Context Window Size (in tokens):
-
-gpt-4: 8192
-gpt-4-0613: 8192
-gpt-4-0314: 8192
-gpt-4-32k: 32768
-gpt-4-32k-0613: 32768
-gpt-4-32k-0314: 32768
-gpt-3.5-turbo: 4096
-gpt-3.5-turbo-16k: 16384
-gpt-3.5-turbo-0613: 4096
-gpt-3.5-turbo-0301: 4096
+        # The context windows are listed from the model registry
+        context_window_list = "\n".join(f"{model}: {context_window:,}"
+                                         for model, context_window in self.context_windows.items())
+        prompt_structure_text = f"Context Window Size (in tokens):\n\n{context_window_list}" + textwrap.dedent("""
 
 Guide to Structuring a Chat Completion prompt for OpenAI LLMs
 
@@ -478,10 +460,15 @@ https://www.promptingguide.ai/
         self.model_menu.set("Select Model")  # default value
         self.model_menu.grid(row=0, column=1, padx=10, pady=5, sticky="w", columnspan=1)
 
+        # Model list status, while the available models are being checked in the background
+        self.model_status = tk.StringVar()
+        self.model_status_label = tk.Label(self.parameters_frame, textvariable=self.model_status, anchor="w")
+        self.model_status_label.grid(row=0, column=2, columnspan=4, padx=5, pady=5, sticky="w")
+
         # API Key
         self.api_key_entry = tk.Entry(self.parameters_frame, width=85)
         self.api_key_entry.grid(row=1, column=1, padx=5, columnspan=4)
-        self.api_key_entry.insert(0, openai.api_key)
+        self.api_key_entry.insert(0, self.api_key)
         self.edit_button = tk.Button(self.parameters_frame, text="Edit API Key", command=self.edit_api_key)
         self.edit_button.grid(row=1, column=0, padx=10)
         self.label_api_key = tk.Label(self.parameters_frame, text="API Key", width=13, anchor="w")
@@ -610,6 +597,17 @@ https://www.promptingguide.ai/
                                   " organization submitted which prompts."
         ToolTip(self.user_label, user_label_tooltip_text)
 
+        # cache responses
+        self.cache_responses_var = tk.BooleanVar(value=False)
+        self.cache_responses_checkbutton = tk.Checkbutton(self.parameters_frame, variable=self.cache_responses_var)
+        self.cache_responses_checkbutton.grid(row=7, column=0, padx=10, pady=5, sticky="w")
+        self.cache_responses_label = tk.Label(self.parameters_frame, text="cache responses", width=16, anchor="w")
+        self.cache_responses_label.grid(row=7, column=1, padx=5, pady=5, sticky="w")
+        cache_responses_label_tooltip_text = "When cache responses is checked, every response is saved on disk, and\n" \
+                                             "a request that is exactly the same as one sent before gets the saved\n" \
+                                             "response back instantly, without calling the API or using any tokens."
+        ToolTip(self.cache_responses_label, cache_responses_label_tooltip_text)
+
         # Context length
         self.context_length = tk.IntVar()
         self.context_length.set(0)
@@ -646,7 +644,8 @@ https://www.promptingguide.ai/
         self.message_buttons_frame.columnconfigure(2, weight=0)  # Button 2
         self.message_buttons_frame.columnconfigure(3, weight=0)  # Button 3
         self.message_buttons_frame.columnconfigure(4, weight=0)  # Button 3
-        self.message_buttons_frame.columnconfigure(5, weight=1)  # Empty column on the right
+        self.message_buttons_frame.columnconfigure(5, weight=0)  # Button 4
+        self.message_buttons_frame.columnconfigure(6, weight=1)  # Empty column on the right
 
         # Buttons
         self.new_prompt_button = tk.Button(self.message_buttons_frame, text="Restore Defaults",
@@ -661,9 +660,18 @@ https://www.promptingguide.ai/
                                               command=self.submit_prompt)
         self.submit_prompt_button.grid(row=3, column=3, padx=5, pady=5)
 
-        self.submit_prompt_button = tk.Button(self.message_buttons_frame, text="Delete prompt",
+        self.delete_prompt_button = tk.Button(self.message_buttons_frame, text="Delete prompt",
                                               command=self.delete_prompt)
-        self.submit_prompt_button.grid(row=3, column=4, padx=5, pady=5)
+        self.delete_prompt_button.grid(row=3, column=4, padx=5, pady=5)
+
+        # The request in progress, which is sent from a worker thread so the window stays usable
+        self.request_task = None
+        self.cancel_request_button = tk.Button(self.message_buttons_frame, text="Cancel request",
+                                               command=self.cancel_request, state="disabled")
+        self.cancel_request_button.grid(row=3, column=5, padx=5, pady=5)
+        self.request_status = tk.StringVar()
+        self.request_status_label = tk.Label(self.message_buttons_frame, textvariable=self.request_status)
+        self.request_status_label.grid(row=4, column=1, columnspan=5, padx=5, pady=2)
 
         # Message components frame
         self.message_components = []
@@ -717,7 +725,47 @@ https://www.promptingguide.ai/
         # Test Button
         self.test_button = tk.Button(self.prompt_test_tab, text="Test",
                                      command=self.run_test)
-        self.test_button.grid(row=3, columnspan=2, padx=10, pady=10, sticky="w")
+        self.test_button.grid(row=3, column=0, padx=10, pady=10, sticky="w")
+
+        # The test run in progress. It runs on a worker thread, so the next prompt can be edited in the meantime.
+        self.test_task = None
+        self.cancel_test_button = tk.Button(self.prompt_test_tab, text="Cancel test", command=self.cancel_test,
+                                            state="disabled")
+        self.cancel_test_button.grid(row=3, column=1, padx=10, pady=10, sticky="w")
+        self.test_progress = tk.StringVar()
+        self.test_progress_label = tk.Label(self.prompt_test_tab, textvariable=self.test_progress)
+        self.test_progress_label.grid(row=10, column=0, columnspan=2, padx=10, pady=10, sticky="w")
+
+        # Number of prompts sent at once in a test run
+        self.concurrency = tk.IntVar(value=DEFAULT_TEST_CONCURRENCY)
+        self.concurrency_spinbox = tk.Spinbox(self.prompt_test_tab, from_=1, to=64, width=5,
+                                              textvariable=self.concurrency)
+        self.concurrency_spinbox.grid(row=7, column=0, padx=10, pady=10, sticky="w")
+        self.concurrency_label = tk.Label(self.prompt_test_tab, text="Concurrent requests")
+        self.concurrency_label.grid(row=7, column=1, padx=10, sticky="w")
+        ToolTip(self.concurrency_label, "The number of prompts that are sent to the API at the same time in a test "
+                                        "run.\nHigher values finish sooner but use up the rate limits faster.")
+
+        # Rate limits of the account, kept to in a test run. They are adjusted to the limits the API reports in the
+        # headers of its responses as the run goes on.
+        self.requests_per_minute = tk.IntVar(value=DEFAULT_REQUESTS_PER_MINUTE)
+        self.requests_per_minute_spinbox = tk.Spinbox(self.prompt_test_tab, from_=1, to=1000000, increment=100,
+                                                      width=8, textvariable=self.requests_per_minute)
+        self.requests_per_minute_spinbox.grid(row=8, column=0, padx=10, pady=10, sticky="w")
+        self.requests_per_minute_label = tk.Label(self.prompt_test_tab, text="Requests per minute")
+        self.requests_per_minute_label.grid(row=8, column=1, padx=10, sticky="w")
+        ToolTip(self.requests_per_minute_label, "The most requests a test run sends in a minute.\nSet this to the "
+                                                "requests-per-minute limit of your account for the model.")
+
+        self.tokens_per_minute = tk.IntVar(value=DEFAULT_TOKENS_PER_MINUTE)
+        self.tokens_per_minute_spinbox = tk.Spinbox(self.prompt_test_tab, from_=1, to=100000000, increment=1000,
+                                                    width=8, textvariable=self.tokens_per_minute)
+        self.tokens_per_minute_spinbox.grid(row=9, column=0, padx=10, pady=10, sticky="w")
+        self.tokens_per_minute_label = tk.Label(self.prompt_test_tab, text="Tokens per minute")
+        self.tokens_per_minute_label.grid(row=9, column=1, padx=10, sticky="w")
+        ToolTip(self.tokens_per_minute_label, "The most tokens a test run uses in a minute, counting the prompt and "
+                                              "max_tokens of each request.\nSet this to the tokens-per-minute limit "
+                                              "of your account for the model.")
 
         # Token Totals
         self.prompt_token_total = tk.StringVar(value="Prompt Tokens: 0")
@@ -778,123 +826,339 @@ https://www.promptingguide.ai/
             print("Error: Failed to load the JSON schema. Aborting the test run.")
             return
 
-        total_prompt_tokens = 0
-        total_completion_tokens = 0
-        total_combined_tokens = 0
+        source_dir = self.source_dir.get()
+        output_dir = self.output_dir.get()
+        source_files = os.listdir(source_dir)
+        template_message_components = self.get_template_message_components()
 
-        with open(os.path.join(self.output_dir.get(), "generated_composite_prompts.txt"),
-                  "w") as generated_prompts_file, \
-                open(os.path.join(self.output_dir.get(), "raw_responses.txt"), "w") as raw_responses_file:
-
-            for file in os.listdir(self.source_dir.get()):
-                print("Processing file:", file)
+        # The request parameters are the same for every prompt, so they are validated once, here on the UI thread
+        # because invalid values are asked about in dialogs. The prompt of each file is put in the request later.
+        request = self.prepare_test_request(template_message_components, output_dir)
+        if request is None:
+            print("Error: The request parameters are not valid. Aborting the test run.")
+            return
+        # The static text of the template is counted once, and each prompt from the tokens of its file content
+        template = PromptTemplate(template_message_components, request["model"], "--{?}--",
+                                  cache=self.get_token_count_cache())
+        context_length = self.context_length.get()
+
+        # The spin boxes accept any text, and the limits have to be positive whole numbers
+        requests_per_minute = self.validate_test_run_setting(self.requests_per_minute, "requests per minute",
+                                                             DEFAULT_REQUESTS_PER_MINUTE)
+        if requests_per_minute is None:
+            return
+        tokens_per_minute = self.validate_test_run_setting(self.tokens_per_minute, "tokens per minute",
+                                                           DEFAULT_TOKENS_PER_MINUTE)
+        if tokens_per_minute is None:
+            return
+        concurrency = self.validate_test_run_setting(self.concurrency, "concurrent requests",
+                                                     DEFAULT_TEST_CONCURRENCY)
+        if concurrency is None:
+            return
 
-                # Detect the encoding of the file
-                with open(os.path.join(self.source_dir.get(), file), 'rb') as f:
-                    result = chardet.detect(f.read())
-                    file_encoding = result['encoding']
+        from async_engine import AsyncRequestEngine
+        rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        retry_policy = RetryPolicy(max_retries_per_run=TEST_RUN_MAX_RETRIES)
+        engine = AsyncRequestEngine(API_KEY, max_concurrency=concurrency,
+                                    rate_limiter=rate_limiter, retry_policy=retry_policy,
+                                    response_cache=self.active_response_cache(), request_timeout=HARD_REQUEST_TIMEOUT)
+
+        generated_prompts_file = open(os.path.join(output_dir, "generated_composite_prompts.txt"), "w")
+        raw_responses_file = open(os.path.join(output_dir, "raw_responses.txt"), "w")
+
+        def run_pipeline(task):
+            """
+            Runs on a worker thread. Every prompt is counted first, a batch of source files at a time, so the prompts
+            that are too long are known before the first request is sent. Then each source file that fits goes through
+            a pipeline of stages: it is read and decoded, its prompt is built and written, the request is sent, and
+            the response is written, validated and saved to Excel. The stages work on different files at the same
+            time, and the bounded queues between them keep the files that are read ahead of the requests to a few.
+            """
+            fitting_files = {}  # (encoding, token count) of the prompt of each file that fits in the context window
+            num_counted = [0]
+
+            def write_prompt(file, test_message_components):
+                # Write generated prompt to file
+                generated_prompts_file.write(json.dumps(test_message_components))
+                generated_prompts_file.write('\n\n------------------------------\n\n')  # for better readability
+                print(f"Written generated prompt for {file}")
 
-                # Now read the file with the detected encoding
-                with open(os.path.join(self.source_dir.get(), file), 'r', encoding=file_encoding) as f:
-                    content = f.read()
+            def read_file(file, file_encoding=None):
+                # Returns the encoding and the content of the file, or None if it cannot be read
+                path = os.path.join(source_dir, file)
+                try:
+                    if file_encoding is None:
+                        file_encoding = self.detect_source_encoding(path)
+                    return file_encoding, self.read_source_file(path, file_encoding)
+                except (OSError, ValueError, LookupError) as e:
+                    print(f"Error reading {file}: {e}")
+                    task.report("failed", file, f"could not be read: {e}")
+                    return None
+
+            def load_for_count(file):
+                if task.cancelled:
+                    return None
+                loaded = read_file(file)
+                return None if loaded is None else (file,) + loaded
+
+            def count_batch(batch):
+                counts = template.count_many([content for _, _, content in batch])
+                for (file, file_encoding, content), num_tokens in zip(batch, counts):
+                    # Check context length
+                    if num_tokens > context_length:
+                        # Handle too long prompt
+                        write_prompt(file, self.build_test_message_components(content, template_message_components))
+                        print(f"Skipping {file}: {num_tokens} tokens exceeds the context length")
+                        task.report("skipped", file, None)
+                    else:
+                        fitting_files[file] = (file_encoding, num_tokens)
+                num_counted[0] += len(batch)
+                task.report("counted", None, num_counted[0])
+
+            def count_prompts(items, pass_on):
+                batch = []
+                for item in items:
+                    batch.append(item)
+                    if len(batch) == TEST_COUNT_BATCH_SIZE:
+                        count_batch(batch)
+                        batch = []
+                if batch:
+                    count_batch(batch)
+
+            def load_file(file):
+                if task.cancelled:
+                    return None
+                print("Processing file:", file)
+                loaded = read_file(file, fitting_files[file][0])
+                if loaded is None:
+                    return None
+                content = loaded[1]
                 print(f"File content of {file}: {content[:100]}...")  # printing the first 100 characters of content
+                return file, content
+
+            def prepare_prompt(item):
+                file, content = item
+                test_message_components = self.build_test_message_components(content, template_message_components)
+                write_prompt(file, test_message_components)
+                print(f"Submitting prompt for {file}: {test_message_components}")
+                return file, build_request_body(dict(request, prompt=test_message_components)), fitting_files[file][1]
+
+            def send_prompts(jobs, pass_on):
+                # Responses are passed on in the order they arrive
+                engine.run(jobs, lambda file, response, error: pass_on((file, response, error)), task.cancel_event)
+
+            def save_result(item):
+                file, response, error = item
+                if error is not None:
+                    # The request failed even after retrying; keep track of it rather than processing an empty
+                    # response
+                    task.report("failed", file, error)
+                    return None
+                self.process_test_response(file, response, schema, raw_responses_file, output_dir)
+                task.report("saved", file, response)
+                return None
+
+            print(f"Counting the tokens of {len(source_files)} prompts")
+            counting = Pipeline()
+            counting.add_stage("load", load_for_count, workers=TEST_LOAD_WORKERS)
+            counting.add_stream_stage("count", count_prompts)
+            counting.run(file for file in source_files if not task.cancelled)
+
+            print(f"Submitting {len(fitting_files)} prompts, {engine.max_concurrency} at a time")
+            pipeline = Pipeline()
+            pipeline.add_stage("load", load_file, workers=TEST_LOAD_WORKERS)
+            # One worker each: the generated prompts and the Excel workbooks are written by one thread at a time
+            pipeline.add_stage("prepare", prepare_prompt)
+            pipeline.add_stream_stage("request", send_prompts)
+            pipeline.add_stage("save", save_result)
+            pipeline.run(file for file in source_files if file in fitting_files and not task.cancelled)
+
+        # Progress is reported by the pipeline and shown here, on the UI thread
+        totals = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        failed_files = []
+        handled_files = set()
+
+        def on_progress(kind, file, detail):
+            if kind == "counted":
+                self.test_progress.set(f"Counted the tokens of {detail} of {len(source_files)} prompts")
+                return
+            handled_files.add(file)
+            if kind == "failed":
+                failed_files.append(f"{file}: {detail}")
+            elif kind == "saved":
+                # Update token counts
+                print(f"Updating token counts for {file}")
+                for key in totals:
+                    totals[key] += (detail.get('usage') or {}).get(key, 0)
+                self.prompt_token_total.set(f"Prompt Tokens: {totals['prompt_tokens']}")
+                self.completion_token_total.set(f"Completion Tokens: {totals['completion_tokens']}")
+                self.combined_token_total.set(f"Combined Tokens: {totals['total_tokens']}")
+            self.test_progress.set(f"{len(handled_files)} of {len(source_files)} prompts done")
+
+        def close_files():
+            generated_prompts_file.close()
+            raw_responses_file.close()
+            self.end_test()
+
+        def finish_test(result):
+            close_files()
+            failed_files.extend(f"{file}: not sent, the test run was cancelled" for file in source_files
+                                if file not in handled_files)
+            # List the prompts that could not be sent, so that only they need to be run again
+            if failed_files:
+                with open(os.path.join(output_dir, "failed_prompts.txt"), "w") as failed_prompts_file:
+                    failed_prompts_file.write("\n".join(failed_files) + "\n")
+                print(f"{len(failed_files)} prompts failed, see failed_prompts.txt")
+                messagebox.showwarning("Test run", f"{len(failed_files)} of {len(source_files)} prompts failed or "
+                                                   f"were cancelled, after {retry_policy.retries} retries in total. "
+                                                   f"They are listed in failed_prompts.txt in the output directory.")
+
+        def test_failed(error):
+            close_files()
+            print(f"Error during the test run: {error}")
+            messagebox.showerror("Test run", f"The test run failed: {error}")
+
+        self.test_button.configure(state="disabled")
+        self.cancel_test_button.configure(state="normal")
+        self.test_progress.set(f"0 of {len(source_files)} prompts done")
+        self.test_task = BackgroundTask(self.root, run_pipeline, on_progress=on_progress, on_done=finish_test,
+                                        on_error=test_failed).start()
+
+    def validate_test_run_setting(self, variable, name, default):
+        """
+        Returns the value of a test run setting that has to be a positive whole number. When it is not one, the user can
+        continue with the default value, or return to the main window to correct it, in which case None is returned.
+        """
+        try:
+            value = variable.get()
+            if value < 1:
+                raise ValueError(f"Invalid {name} value")
+        except (tk.TclError, ValueError):
+            message_box = CustomMessageBox(
+                self.prompt_test_tab, f"Invalid {name} value",
+                f"Invalid {name} value entered. Continue with the default value ({default}) or return to the main "
+                f"window to provide a valid value?"
+            )
+            if message_box.result:
+                variable.set(default)
+                return default
+            return None
+        return value
 
-                # Make a fresh copy of the prompt template for each file
-                # test_message_components = copy.deepcopy(self.message_components)
-
-                test_message_components = []
+    def cancel_test(self):
+        """Cancel the test run. The prompts already answered are kept, and the rest are listed as failed."""
+        if self.test_task is not None:
+            print("Cancelling the test run")
+            self.test_progress.set("Cancelling...")
+            self.test_task.cancel(wait=True)
+
+    def end_test(self):
+        self.test_task = None
+        self.test_button.configure(state="normal")
+        self.cancel_test_button.configure(state="disabled")
+
+    def process_test_response(self, file, response, schema, raw_responses_file, output_directory):
+        """Write, validate and save the response to the prompt for one source file. Runs on the worker thread of a
+        test run, so it must not touch the UI."""
+        try:
+            print(f"Received response for {file}: {response}")
+            # Write raw response to file
+            raw_responses_file.write(json.dumps(response))
+            raw_responses_file.write('\n\n------------------------------\n\n')  # for better readability
+
+            # Handle JSON extraction and validation
+            if isinstance(response, dict):
+                response_str = json.dumps(response)
+                extracted_json = self.extract_json_from_response(response_str)
+                print(f"JSON extracted from response_str for {file}: {extracted_json}")
+            else:
+                # Log an error message for unexpected response types
+                print(f"Unexpected response type {type(response)} when processing. Expected a dictionary.")
+                # Optionally, raise an exception to halt the process (if this is considered a critical error)
+                # raise TypeError(f"Unexpected response type {type(response)}. Expected a dictionary.")
+            validated_json = self.validate_and_capture_json(extracted_json,
+                                                            schema)
+            print(f"Validated Response JSON for {file}: {validated_json}")
+
+            # Save the validated JSON with validation details to Excel
+            print(f"Saving validated JSON for {file} in run_test()")
+            self.save_expanded_json_to_excel(output_directory, validated_json)
+
+            work_order_json = None
+            print(f"Extracting work order JSON for {file}")
+            print(f"Choices is in extracted json: ", 'choices' in extracted_json)
+            print(f"Number of choices: ", len(extracted_json['choices']))
+            print("\n\n\n\n\n\n\n\n**************\n\n\n\n\n\n\n\n")
+            if extracted_json and 'choices' in extracted_json and len(extracted_json['choices']) > 0:
+                content_str = extracted_json['choices'][0]['message'].get('content', "")
+                print(f"Content string for {file}: {content_str}")
+                work_order_json = self.extract_json_from_response(content_str)
+                print(f"Work order JSON for {file}: {work_order_json}")
+
+            # Save the work order to Excel
+            if work_order_json:
+                print(f"Saving work order JSON for {file} in run_test()")
+                self.save_work_order_to_excel(output_directory, work_order_json, schema)
+
+        except Exception as e:
+            # Handle errors during writing to file, or JSON handling
+            print(f"Error processing file {file}: {str(e)}")
+            pass
+
+    def detect_source_encoding(self, path):
+        """Return the detected encoding of a source file"""
+        import chardet
+
+        with open(path, 'rb') as f:
+            result = chardet.detect(f.read())
+            return result['encoding']
+
+    def read_source_file(self, path, file_encoding=None):
+        """Read a source file using its detected encoding, or file_encoding if it has already been detected"""
+        if file_encoding is None:
+            file_encoding = self.detect_source_encoding(path)
+
+        # Now read the file with the detected encoding
+        with open(path, 'r', encoding=file_encoding) as f:
+            return f.read()
+
+    def get_template_message_components(self):
+        """Return the message components as plain role and content strings, with the delimiter still in place"""
+        template_message_components = []
+
+        for msg in self.message_components:
+            print(f"Processing message: {msg}")
+            print(f"msg['role'] type: {type(msg['role'])}, value: {msg['role']}")
+            template_msg = {
+                'role': msg['role'].get() if isinstance(msg['role'], tk.StringVar) else msg['role'],
+                'content': msg['content'].get() if isinstance(msg['content'], tk.StringVar) else msg['content']
+            }
+            print(f"Constructed test message: {template_msg}")
+            template_message_components.append(template_msg)
 
-                for msg in self.message_components:
-                    print(f"Processing message: {msg}")
-                    print(f"msg['role'] type: {type(msg['role'])}, value: {msg['role']}")
-                    test_msg = {
-                        'role': msg['role'].get() if isinstance(msg['role'], tk.StringVar) else msg['role'],
-                        'content': msg['content'].get() if isinstance(msg['content'], tk.StringVar) else msg['content']
-                    }
-                    print(f"Constructed test message: {test_msg}")
-                    test_message_components.append(test_msg)
+        return template_message_components
 
-                # Replace delimiter in test_message_components with file content
-                for message in test_message_components:
-                    message["content"] = message["content"].replace("--{?}--", content)
-                    print(f"Message after delimiter replacement: {message['content'][:100]}...")  # first 100 characters
+    def build_test_message_components(self, content, template_message_components=None):
+        """Return a fresh copy of the prompt template with the delimiter replaced by the file content"""
+        if template_message_components is None:
+            template_message_components = self.get_template_message_components()
 
-                # Write generated prompt to file
-                generated_prompts_file.write(json.dumps(test_message_components))
-                generated_prompts_file.write('\n\n------------------------------\n\n')  # for better readability
-                print(f"Written generated prompt for {file}")
+        # Replace delimiter in test_message_components with file content
+        test_message_components = []
+        for message in template_message_components:
+            test_message_components.append(dict(message, content=message["content"].replace("--{?}--", content)))
+            print(f"Message after delimiter replacement: {test_message_components[-1]['content'][:100]}...")
 
-                # Check context length
-                num_tokens = num_tokens_from_messages(test_message_components, self.model_var.get())
-                if num_tokens > self.context_length.get():
-                    # Handle too long prompt
-                    continue
+        return test_message_components
 
-                # Submit prompt
-                try:
-                    print(f"Submitting prompt for {file}: {test_message_components}")
-                    response = self.submit_test_prompt(test_message_components, self.output_dir.get())
-
-                    print(f"Received response for {file}: {response}")
-                    # Write raw response to file
-                    raw_responses_file.write(json.dumps(response))
-                    raw_responses_file.write('\n\n------------------------------\n\n')  # for better readability
-
-                    # Update token counts
-                    if isinstance(response, dict):
-                        print(f"Updating total_prompt_tokens count for {file}")
-                        total_prompt_tokens += response.get('usage', {}).get("prompt_tokens", 0)
-                        print(f"Updating total_completion_tokens count for {file}")
-                        total_completion_tokens += response.get('usage', {}).get("completion_tokens", 0)
-                        print(f"Updating total_combined_tokens count for {file}")
-                        total_combined_tokens += response.get('usage', {}).get("total_tokens", 0)
-                    else:
-                        print(
-                            f"Warning: Unexpected response type for {file}. Expected a dictionary but got {type(response)}.")
-
-                    self.prompt_token_total.set(f"Prompt Tokens: {total_prompt_tokens}")
-                    self.completion_token_total.set(f"Completion Tokens: {total_completion_tokens}")
-                    self.combined_token_total.set(f"Combined Tokens: {total_combined_tokens}")
-
-                    # Handle JSON extraction and validation
-                    if isinstance(response, dict):
-                        response_str = json.dumps(response)
-                        extracted_json = self.extract_json_from_response(response_str)
-                        print(f"JSON extracted from response_str for {file}: {extracted_json}")
-                    else:
-                        # Log an error message for unexpected response types
-                        print(f"Unexpected response type {type(response)} when processing. Expected a dictionary.")
-                        # Optionally, raise an exception to halt the process (if this is considered a critical error)
-                        # raise TypeError(f"Unexpected response type {type(response)}. Expected a dictionary.")
-                    validated_json = self.validate_and_capture_json(extracted_json,
-                                                                    schema)
-                    print(f"Validated Response JSON for {file}: {validated_json}")
-
-                    # Save the validated JSON with validation details to Excel
-                    print(f"Saving validated JSON for {file} in run_test()")
-                    output_directory = self.output_dir.get()
-                    self.save_expanded_json_to_excel(output_directory, validated_json)
-
-                    work_order_json = None
-                    print(f"Extracting work order JSON for {file}")
-                    print(f"Choices is in extracted json: ", 'choices' in extracted_json)
-                    print(f"Number of choices: ", len(extracted_json['choices']))
-                    print("\n\n\n\n\n\n\n\n**************\n\n\n\n\n\n\n\n")
-                    if extracted_json and 'choices' in extracted_json and len(extracted_json['choices']) > 0:
-                        content_str = extracted_json['choices'][0]['message'].get('content', "")
-                        print(f"Content string for {file}: {content_str}")
-                        work_order_json = self.extract_json_from_response(content_str)
-                        print(f"Work order JSON for {file}: {work_order_json}")
-
-                    # Save the work order to Excel
-                    if work_order_json:
-                        print(f"Saving work order JSON for {file} in run_test()")
-                        self.save_work_order_to_excel(output_directory, work_order_json, schema)
-
-                except Exception as e:
-                    # Handle errors during prompt submission, writing to file, or JSON handling
-                    print(f"Error processing file {file}: {str(e)}")
-                    pass
+    def get_token_count_cache(self):
+        """Return the persistent token count cache, or None if it cannot be opened"""
+        if self.token_count_cache is None:
+            try:
+                self.token_count_cache = TokenCountCache()
+            except sqlite3.Error as e:
+                print(f"Warning: could not open the token count cache, counting without it: {e}")
+        return self.token_count_cache
 
     def extract_json_from_response(self, response):
         """
@@ -921,6 +1185,7 @@ https://www.promptingguide.ai/
         return None
 
     def validate_and_capture_json(self, data, schema):
+        from jsonschema import validate, ValidationError
         try:
             validate(data, schema)
             expanded_json = {
@@ -947,6 +1212,9 @@ https://www.promptingguide.ai/
             return expanded_json
 
     def save_expanded_json_to_excel(self, directory, expanded_json):
+        import pandas as pd
+        from openpyxl import load_workbook
+
         file_path = os.path.join(directory, "validation_results.xlsx")
 
         # If the file doesn't exist, create it
@@ -1005,6 +1273,9 @@ https://www.promptingguide.ai/
             df_originals.to_excel(writer, sheet_name='Original_JSONs', index=False)
 
     def save_work_order_to_excel(self, directory, work_order_json, schema):
+        import pandas as pd
+        from openpyxl import load_workbook
+
         file_path = os.path.join(directory, "work_orders.xlsx")
 
         # Convert JSON to a DataFrame for the main data
@@ -1046,10 +1317,10 @@ https://www.promptingguide.ai/
                     # If the "Work Orders" sheet doesn't exist, simply write the new work order data
                     df_main.to_excel(writer, sheet_name="Work Orders", index=False)
 
-    def submit_test_prompt(self, test_message_components, output_dir):
+    def prepare_test_request(self, test_message_components, output_dir):
         """
-        The declaration for the send request method is: def send_request(model, prompt, temperature, top_p, n, stream,
-        stop, max_tokens, presence_penalty, frequency_penalty, logit_bias, user):
+        Validates the model and the request parameters and returns the request for a test prompt, as a dictionary of
+        the arguments of send_request, or None if the prompt cannot be sent.
         """
 
         # Validate model based on the available models supported by the API
@@ -1197,7 +1468,7 @@ https://www.promptingguide.ai/
                 max_tokens = None
             else:
                 max_tokens = int(max_tokens_str)
-                if max_tokens < 1 or max_tokens > self.context_windows:
+                if max_tokens < 1 or max_tokens > registry.max_output_tokens(model):
                     raise ValueError("Invalid max_tokens value")
         except ValueError:
             message_box = CustomMessageBox(
@@ -1332,12 +1603,7 @@ https://www.promptingguide.ai/
         print(f"Frequency penalty: {frequency_penalty}")
         print(f"Logit bias: {logit_bias}")
         print(f"User: {user}")
-        # Send the request
-        response = send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
-                                frequency_penalty, logit_bias, user)
-        print(f"Received response: {response}")
-        self.display_response(response)
-        return response
+        return request
 
     def update_context_length(self, *args):
         selected_model = self.model_var.get()
@@ -1349,17 +1615,58 @@ https://www.promptingguide.ai/
         self.context_length.set(context_length)
 
     def refresh_model_list(self):
-        new_model_list = populate_model_list(self.context_windows, self.api_key)
-        print("Updating model list: " + str(new_model_list))
-        self.model_menu['values'] = ["Select Model"] + new_model_list
-        self.model_list = new_model_list
+        self.load_models_in_background(refresh=True)
+
+    def load_models_in_background(self, refresh=False):
+        """
+        Fills the model list without blocking the UI. The cached list of the API key is shown at once if there is one,
+        and the list is then checked with the API on a worker thread, unless the cached list is fresh. refresh checks
+        it with the API in any case.
+        """
+        # Pick up any change to the model registry file first
+        registry.reload_if_changed()
+        cached_ids = cached_model_ids(self.api_key)
+        if cached_ids is not None:
+            self.set_model_list(known_models(cached_ids, self.context_windows))
+        self.model_status.set("Checking the API key and the available models...")
+        # The check runs on a daemon thread, so a slow list call does not keep the application alive once it is closed
+        api_key = self.api_key
+        BackgroundTask(self.root, lambda task: list_model_ids(api_key, refresh=refresh),
+                       on_done=lambda model_ids: self.show_model_check(api_key, model_ids),
+                       on_error=lambda error: self.show_model_check(api_key, error=error),
+                       poll_interval=MODEL_CHECK_POLL_INTERVAL).start()
+
+    def show_model_check(self, api_key, model_ids=None, error=None):
+        """Shows the result of a model check started by load_models_in_background."""
+        if api_key != self.api_key:
+            # The API key was changed while its models were being checked
+            return
+        if error is not None:
+            print(f"Error while fetching the list of models: {error}")
+            self.model_status.set("Could not check the models. Check the API key and the connection.")
+            return
+        model_list = known_models(model_ids, self.context_windows)
+        self.set_model_list(model_list)
+        self.model_status.set(f"{len(model_list)} models available")
+
+    def set_model_list(self, model_list):
+        print("Updating model list: " + str(model_list))
+        self.model_menu['values'] = ["Select Model"] + model_list
+        self.model_list = model_list
 
     def edit_api_key(self):
         # Here is where you'd put the logic to edit the API Key
+        global API_KEY
         new_api_key = get_api_key(self.root)
         if new_api_key:
             self.api_key_entry.delete(0, 'end')
             self.api_key_entry.insert(0, new_api_key)
+            # Requests from now on use the new key, through a client built for it
+            API_KEY = new_api_key
+            self.api_key = new_api_key
+            from openai_client import client_manager
+            client_manager.set_api_key(new_api_key)
+            self.load_models_in_background()
 
     def validate_model(self):
 
@@ -1371,7 +1678,7 @@ https://www.promptingguide.ai/
         print("Validating model")
         model = self.model_var.get()
         if model == "Refresh Model List":
-            populate_model_list(self.context_windows, self.model_list)
+            self.refresh_model_list()
             return False
         if model not in self.model_list:
             messagebox.showerror("Error", "Invalid model. Please select a valid model.")
@@ -1514,8 +1821,9 @@ https://www.promptingguide.ai/
         Required. Messages is an array of messages in the format "[role]":"[message]".
         """
         for item in self.message_components:
-            role = item['role']
-            content = item['content']
+            # The request is sent from a worker thread, which must not touch Tk, so the values are read here
+            role = item['role'].get() if isinstance(item['role'], tk.StringVar) else item['role']
+            content = item['content'].get() if isinstance(item['content'], tk.StringVar) else item['content']
             messages_list.append({'role': role, 'content': content})
 
         # Validate the total number of tokens in the prompt
@@ -1640,7 +1948,7 @@ https://www.promptingguide.ai/
                 max_tokens = None
             else:
                 max_tokens = int(max_tokens_str)
-                if max_tokens < 1 or max_tokens > self.context_windows:
+                if max_tokens < 1 or max_tokens > registry.max_output_tokens(model):
                     raise ValueError("Invalid max_tokens value")
         except ValueError:
             message_box = CustomMessageBox(
@@ -1742,9 +2050,55 @@ https://www.promptingguide.ai/
         # (model, prompt, temperature, top_p, n, stop, max_tokens, presence_penalty, frequency_penalty, logit_bias,
         #  user)
         print("Parameters validated. Sending request...")
-        response = send_request(model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
-                                frequency_penalty, logit_bias, user)
-        self.display_response(response)
+        request_args = (model, prompt, temperature, top_p, n, stream, stop, max_tokens, presence_penalty,
+                        frequency_penalty, logit_bias, user)
+        response_cache = self.active_response_cache()
+
+        def show_response(response):
+            # send_request returns None when the API rejected the request
+            if response is None:
+                messagebox.showerror("Error", "The request failed. See the console output for the error.")
+                return
+            self.display_response(response)
+
+        self.start_request(lambda task: send_request(*request_args, response_cache=response_cache),
+                           on_done=show_response)
+
+    def start_request(self, function, on_done):
+        """
+        Runs function(task) on a worker thread, so the window stays usable while a request is sent. The Submit button
+        is disabled and the Cancel request button enabled until it ends, and a request still running after
+        HARD_REQUEST_TIMEOUT seconds is given up on. on_done is called on the UI thread.
+        """
+        def finish():
+            self.request_task = None
+            self.submit_prompt_button.configure(state="normal")
+            self.cancel_request_button.configure(state="disabled")
+
+        def done(result):
+            finish()
+            self.request_status.set("")
+            on_done(result)
+
+        def failed(error):
+            finish()
+            if isinstance(error, TaskCancelled):
+                self.request_status.set("Request cancelled")
+                return
+            self.request_status.set("")
+            print(f"Error while sending the request: {error}")
+            messagebox.showerror("Error", f"The request failed: {error}")
+
+        self.submit_prompt_button.configure(state="disabled")
+        self.cancel_request_button.configure(state="normal")
+        self.request_status.set("Waiting for the response...")
+        self.request_task = BackgroundTask(self.root, function, on_done=done, on_error=failed,
+                                           timeout=HARD_REQUEST_TIMEOUT).start()
+
+    def cancel_request(self):
+        if self.request_task is not None:
+            print("Cancelling the request")
+            self.request_task.cancel()
 
     def reset_prompt_gui(self):
         print(
@@ -1755,7 +2109,7 @@ https://www.promptingguide.ai/
         # Reset entries
         self.model_var.set("Select Model")
         self.api_key_entry.delete(0, tk.END)
-        self.api_key_entry.insert(0, openai.api_key)
+        self.api_key_entry.insert(0, API_KEY)
         self.temperature_entry.delete(0, tk.END)
         self.temperature_entry.insert(0, "0.7")
         self.top_p_entry.delete(0, tk.END)
@@ -1793,6 +2147,10 @@ https://www.promptingguide.ai/
         # Reset token count
         self.token_count.set(0)
 
+    def active_response_cache(self):
+        """Return the response cache if cache responses is checked, otherwise None."""
+        return get_response_cache() if self.cache_responses_var.get() else None
+
     def display_response(self, response):
         print("Response received. Displaying response...")
         for widget in self.results_tab.winfo_children():
@@ -1821,9 +2179,9 @@ https://www.promptingguide.ai/
         usage_label.grid(row=3, column=0, padx=5, pady=2, sticky="w")
 
         # Usage text
-        usage_text = f"Completion tokens: {response.usage['completion_tokens']}\n" \
-                     f"Prompt tokens: {response.usage['prompt_tokens']}\n" \
-                     f"Total tokens: {response.usage['total_tokens']}"
+        usage_text = f"Completion tokens: {response.usage.completion_tokens}\n" \
+                     f"Prompt tokens: {response.usage.prompt_tokens}\n" \
+                     f"Total tokens: {response.usage.total_tokens}"
         usage_text_widget = tk.Text(self.response_parameters_frame, wrap=tk.WORD, height=4, width=30)
         usage_text_widget.insert(tk.END, usage_text)
         usage_text_widget.configure(state='disabled')
@@ -1843,53 +2201,14 @@ https://www.promptingguide.ai/
         response_text.pack(padx=10, pady=10, fill=tk.BOTH, expand=True)
 
 
-def populate_model_list(context_window, api_key):
-    """Iterates through the set of models in the context_window global variable and tries an api call for that model
-     using the is_valid_api_key_model function. If the API call is successful, adds the model name to the model_list,
-     otherwise proceeds to the next model in the context_window list. When all models have been tested, returns the
-     model_list.
-
-  Args:
-    api_key: The OpenAI API key to use for the API calls.
-    context_window: A dictionary of model names and context window sizes.
-
-  Returns:
-    A list of the model names that are valid for the provided API key.
-  """
-    # TODO: Dynamically generate the context_window dictionary from JSON returned from this API call:
-    # models = openai.Model.list()
-    # for model in models['data']:
-    #     print(model['id'])
-    #
-    # or somewhere like this:
-    # https://github.com/terminalcommandnewsletter/everything-chatgpt
-    model_list = []
-    for model_name, context_window in context_window.items():
-        print(f"Testing {model_name}...")
-        if not is_valid_api_key_model(api_key, model_name):
-            model_list.append(model_name)
-
-    return model_list
-
-
 if __name__ == "__main__":
-    context_windows = {
-        "gpt-4": 8192,
-        "gpt-4-0613": 8192,
-        "gpt-4-0314": 8192,
-        "gpt-4-32k": 32768,
-        "gpt-4-32k-0613": 32768,
-        "gpt-4-32k-0314": 32768,
-        "gpt-3.5-turbo": 4096,
-        "gpt-3.5-turbo-16k": 16384,
-        "gpt-3.5-turbo-0613": 4096,
-        "gpt-3.5-turbo-instruct": 4096,
-        "gpt-3.5-turbo-0301": 4096,
-        "gpt-3.5-turbo-16k-0613": 16384
-    }
+    context_windows = CONTEXT_WINDOWS
+    # Load the tokenizer while the API key is checked and the UI is built
+    preload_encodings(context_windows)
     api_key = None
     app_root = tk.Tk()
-    openai.api_key = check_api_key(app_root, api_key)
-    model_list = populate_model_list(context_windows, openai.api_key)
-    app = PromptUI(app_root, model_list, context_windows, openai.api_key)
+    check_api_key(app_root, api_key)
+    # The window is shown at once, and the model list is filled in as the available models are checked
+    app = PromptUI(app_root, [], context_windows, API_KEY)
+    app.load_models_in_background()
     app_root.mainloop()
@@ -0,0 +1,114 @@
+import time
+import asyncio
+from token_engine import num_tokens_from_messages
+
+"""
+Client-side rate limiting for batch runs.
+
+The API limits every account to a number of requests and a number of tokens per minute, and answers anything over
+either limit with a 429 error. The rate limiter keeps a token bucket for each limit. Before a request is sent it
+reserves one request and the tokens the request can use (the prompt plus max_tokens for each of the n completions,
+which is how the API counts them), waiting until both buckets have room. When the response arrives the reservation is
+corrected to the tokens actually used, and the x-ratelimit-* headers of the response bring the buckets in line with the
+limits and the remaining capacity the API reports.
+"""
+
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 10000
+# Tokens reserved for the completion of a request that does not set max_tokens. The reservation is corrected to the
+# actual usage when the response arrives.
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+def estimate_request_tokens(request_body, prompt_tokens=None):
+    """
+    Return the number of tokens a chat completion request can use: the prompt plus max_tokens for each of the n
+    completions. prompt_tokens is the token count of the prompt, if it has already been counted.
+    """
+    if prompt_tokens is None:
+        prompt_tokens = num_tokens_from_messages(request_body["messages"], model=request_body["model"])
+    completion_tokens = request_body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens * (request_body.get("n") or 1)
+
+
+class TokenBucket:
+    """
+    A bucket that holds up to capacity units and refills at capacity units per minute.
+    """
+
+    def __init__(self, capacity):
+        if capacity <= 0:
+            # An empty bucket would never refill
+            raise ValueError("A token bucket needs a capacity greater than zero.")
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Return the number of seconds until amount can be taken. More than the capacity can be taken from a full
+        bucket, so that a single large request is never blocked forever."""
+        self.refill()
+        shortfall = min(amount, self.capacity) - self.level
+        return max(0.0, shortfall * 60 / self.capacity)
+
+    def take(self, amount):
+        self.refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        self.refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def update(self, limit=None, remaining=None):
+        """Adjust the bucket to the limit and the remaining capacity reported by the API."""
+        self.refill()
+        if limit:
+            self.capacity = limit
+        if remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class RateLimiter:
+    """
+    Keeps batch submissions under a requests-per-minute and a tokens-per-minute limit.
+    """
+
+    def __init__(self, requests_per_minute=DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute=DEFAULT_TOKENS_PER_MINUTE):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, num_tokens):
+        """Wait until a request that can use num_tokens tokens may be sent, and reserve it. Requests are let through
+        in the order they asked."""
+        async with self.lock:
+            while True:
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(num_tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(num_tokens)
+
+    def reconcile(self, reserved_tokens, used_tokens):
+        """Correct a reservation of reserved_tokens to the used_tokens the response reported."""
+        if used_tokens < reserved_tokens:
+            self.tokens.give_back(reserved_tokens - used_tokens)
+        else:
+            self.tokens.take(used_tokens - reserved_tokens)
+
+    def update_from_headers(self, headers):
+        """Adjust the buckets to the x-ratelimit-* headers of a response."""
+        def header(name):
+            try:
+                return int(headers.get(name))
+            except (TypeError, ValueError):
+                return None
+
+        self.requests.update(header("x-ratelimit-limit-requests"), header("x-ratelimit-remaining-requests"))
+        self.tokens.update(header("x-ratelimit-limit-tokens"), header("x-ratelimit-remaining-tokens"))
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from token_engine import CACHE_DIR
+
+"""
+A persistent cache of chat completion responses.
+
+Sending the same request twice costs the same twice, even though there is often no need for a new response, as when a
+test run is repeated after changing only the schema or the Excel export. With the cache turned on, every response is
+stored in an SQLite database under a hash of the canonical form of its request (the model, messages and every sampling
+parameter), and a request that has been sent before is answered from the database without calling the API. A cached
+response is a replay: it is the same response however random the sampling parameters would have made a new one.
+
+The database is kept under MAX_CACHE_SIZE by evicting the least recently used responses.
+"""
+
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "responses.sqlite3")
+MAX_CACHE_SIZE = 256 * 1024 * 1024  # bytes of response JSON kept in the cache
+
+# Request fields that change how the response is delivered, not what it is
+TRANSPORT_FIELDS = {"stream", "stream_options"}
+
+
+def request_key(request_body):
+    """
+    Return the key of a chat completion request: the SHA-256 hash of its fields in canonical JSON. Fields that are not
+    sent (None or empty) are left out, so a request has the same key however its optional fields were left empty.
+    """
+    canonical = {key: value for key, value in request_body.items()
+                 if key not in TRANSPORT_FIELDS and value is not None and value != "" and value != [] and value != {}}
+    text = json.dumps(canonical, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Chat completion responses by request key, in an SQLite database, with least recently used eviction once the
+    responses take up more than max_size bytes.
+
+    The cache can be shared between threads.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_size=MAX_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.connection.commit()
+
+    def get(self, key):
+        """Return the cached response for key as a dictionary, or None if there is none."""
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        """Store a response dictionary under key, and evict the least recently used responses if the cache is full."""
+        text = json.dumps(response)
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, text, len(text), time.time()),
+            )
+            total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size > self.max_size:
+                evicted = []
+                for evicted_key, size in self.connection.execute(
+                        "SELECT key, size FROM responses ORDER BY last_used"):
+                    if total_size <= self.max_size:
+                        break
+                    evicted.append((evicted_key,))
+                    total_size -= size
+                self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+                print(f"Evicted {len(evicted)} responses from the response cache")
+
+    def clear(self):
+        """Remove every cached response."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the shared response cache, opening it on first use."""
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache()
+        return response_cache
@@ -0,0 +1,154 @@
+import time
+import random
+import asyncio
+import threading
+import email.utils
+
+"""
+Retries for failed API requests.
+
+A request that failed because of a rate limit (429), a server error (5xx), a timeout or a dropped connection will
+usually succeed if it is sent again a little later, so the retry policy sends it again after an exponential backoff with
+full jitter, or after the delay the API asked for in its Retry-After header. Any other error, such as an invalid request
+or a bad API key, will fail again the same way and is raised at once. Retries are capped per request, and optionally
+per run, so that an outage does not keep a batch retrying for hours.
+
+Errors are classified by their attributes rather than their types, so the errors of both the 0.x and the 1.x OpenAI
+libraries and of httpx are handled the same way.
+"""
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+# Errors without a status code that are worth retrying, by class name
+RETRYABLE_ERROR_NAMES = {"APITimeoutError", "APIConnectionError", "Timeout", "TimeoutException", "TimeoutError",
+                         "ConnectError", "ReadError", "RemoteProtocolError", "ServiceUnavailableError", "TryAgain",
+                         "RateLimitError", "ConnectionError"}
+# Error codes that come with a retryable status code but will not go away by waiting
+FATAL_ERROR_CODES = {"insufficient_quota"}
+
+MAX_ATTEMPTS = 5  # attempts per request, including the first
+BASE_DELAY = 1.0  # seconds, doubled after every failed attempt
+MAX_DELAY = 60.0  # seconds, the longest backoff between two attempts
+MAX_RETRY_AFTER = 300.0  # seconds, the longest Retry-After delay that is honored
+
+
+def error_status_code(error):
+    """Return the HTTP status code of error, or None if it has none."""
+    for name in ("status_code", "http_status"):
+        status_code = getattr(error, name, None)
+        if isinstance(status_code, int):
+            return status_code
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def error_headers(error):
+    """Return the response headers of error, or an empty dictionary if it has none."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        headers = getattr(error, "headers", None)
+    return headers or {}
+
+
+def is_retryable(error):
+    """Return True if the request that raised error may succeed when it is sent again."""
+    code = getattr(error, "code", None)
+    if code in FATAL_ERROR_CODES:
+        return False
+    status_code = error_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after(error):
+    """Return the number of seconds the API asked to wait before sending the request again, or None."""
+    headers = error_headers(error)
+    try:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return float(value) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    # Retry-After can also be an HTTP date
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed request is sent again. max_retries_per_run caps the retries of every request
+    sent through the policy together; None means no cap. The policy can be shared between threads.
+    """
+
+    def __init__(self, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 max_retries_per_run=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries_per_run = max_retries_per_run
+        self.retries = 0
+        self.lock = threading.Lock()
+
+    def should_retry(self, error, attempt):
+        """
+        Return True if the request should be sent again after failing with error on its attempt-th attempt, and count
+        the retry against the run.
+        """
+        if attempt >= self.max_attempts or not is_retryable(error):
+            return False
+        with self.lock:
+            if self.max_retries_per_run is not None and self.retries >= self.max_retries_per_run:
+                print("Not retrying: the retries for this run have been used up")
+                return False
+            self.retries += 1
+        return True
+
+    def delay(self, error, attempt):
+        """Return the number of seconds to wait before the attempt after the attempt-th one."""
+        requested_delay = retry_after(error)
+        if requested_delay is not None:
+            return min(requested_delay, MAX_RETRY_AFTER)
+        # Full jitter: a random delay up to the exponential backoff, so that requests that failed together do not all
+        # come back at the same moment
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, function, *args, **kwargs):
+        """Call function, calling it again after a delay for as long as it fails with a retryable error."""
+        attempt = 1
+        while True:
+            try:
+                return function(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.delay(e, attempt)
+                print(f"Request failed ({e}), retrying in {delay:.1f} seconds (attempt {attempt + 1} of "
+                      f"{self.max_attempts})")
+                time.sleep(delay)
+                attempt += 1
+
+    async def call_async(self, function, *args, **kwargs):
+        """The coroutine version of call, for a function that returns an awaitable."""
+        attempt = 1
+        while True:
+            try:
+                return await function(*args, **kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.delay(e, attempt)
+                print(f"Request failed ({e}), retrying in {delay:.1f} seconds (attempt {attempt + 1} of "
+                      f"{self.max_attempts})")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+# The policy for requests sent one at a time from the GUIs, with no cap per run
+default_retry_policy = RetryPolicy()
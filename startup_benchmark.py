@@ -0,0 +1,142 @@
+import sys
+import argparse
+import subprocess
+import statistics
+
+"""
+Startup benchmark for the GUI tools.
+
+Everything a GUI module imports at load time runs before its window can appear, so this measures the import time of the
+module with the interpreter's -X importtime report and fails when it is over the budget, or when a dependency that is
+meant to be imported on first use has crept back into the startup path. The time until the main window has been built
+and drawn is measured as well, by making the same calls as the module's __main__ block (this needs a display, and is
+skipped with --no-ui).
+
+Usage: python startup_benchmark.py [--no-ui] [module ...]
+"""
+
+IMPORT_TIME_BUDGET_MS = 500
+UI_STARTUP_BUDGET_MS = 1000
+RUNS = 5
+
+# Dependencies each module must not import at startup
+LAZY_MODULES = {
+    "prompt_tester": ["openai", "tiktoken", "jsonschema", "chardet", "pandas", "openpyxl"],
+}
+# Dependencies that are loaded on a background thread while the window is built, so they may be loaded by then
+BACKGROUND_MODULES = ["tiktoken"]
+
+# The calls made by the __main__ block of the GUIs, except that a missing API key is not asked for
+UI_STARTUP_CODE = """
+import sys
+import time
+start = time.perf_counter()
+import tkinter as tk
+import {module} as gui
+gui.preload_encodings(gui.CONTEXT_WINDOWS)
+root = tk.Tk()
+if gui.keyring.get_password("openai", "api_key"):
+    gui.check_api_key(root)
+app = gui.PromptUI(root, [], gui.CONTEXT_WINDOWS, gui.API_KEY)
+loaded = [name for name in {lazy_modules!r} if name in sys.modules]
+app.load_models_in_background()
+root.update()
+print("startup time", time.perf_counter() - start)
+print("startup imports", *loaded)
+root.destroy()
+"""
+
+
+def measure_import_time(module):
+    """Returns the cumulative import time of module in milliseconds, and the ten slowest imports under it"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1000, name.rstrip()))
+
+    # A module is reported after everything it imports, which is indented under it
+    position = next(index for index, (_, name) in enumerate(imports) if name.strip() == module)
+    total, name = imports[position]
+    indent = len(name) - len(name.lstrip())
+    start = position
+    while start > 0 and len(imports[start - 1][1]) - len(imports[start - 1][1].lstrip()) > indent:
+        start -= 1
+    return total, sorted(imports[start:position], reverse=True)[:10]
+
+
+def find_eager_imports(module):
+    """Returns the modules in LAZY_MODULES that are loaded by importing module"""
+    lazy_modules = LAZY_MODULES.get(module, [])
+    code = f"import sys, {module}; print(' '.join(name for name in {lazy_modules!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+    # The module may print while it is imported; the names are on the last line
+    return result.stdout.splitlines()[-1].split()
+
+
+def measure_ui_startup(module):
+    """
+    Returns the time in milliseconds from starting the interpreter until the main window of module is drawn, and the
+    modules in LAZY_MODULES that were loaded on the way, or None if the window could not be built
+    """
+    lazy_modules = [name for name in LAZY_MODULES.get(module, []) if name not in BACKGROUND_MODULES]
+    result = subprocess.run([sys.executable, "-c", UI_STARTUP_CODE.format(module=module, lazy_modules=lazy_modules)],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+        return None
+    # The module prints as it starts; the results are on the lines marked for them
+    startup_time = None
+    startup_imports = []
+    for line in result.stdout.splitlines():
+        if line.startswith("startup time "):
+            startup_time = float(line.split()[2]) * 1000
+        elif line.startswith("startup imports"):
+            startup_imports = line.split()[2:]
+    return startup_time, startup_imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the startup time of the GUI tools against a budget.")
+    parser.add_argument("modules", nargs="*", default=list(LAZY_MODULES), help="modules to measure")
+    parser.add_argument("--no-ui", dest="ui", action="store_false",
+                        help="skip measuring the time until the main window is drawn")
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules:
+        runs = [measure_import_time(module) for _ in range(RUNS)]
+        import_time = statistics.median(total for total, _ in runs)
+        print(f"{module}: imported in {import_time:.0f} ms (median of {RUNS}, budget {IMPORT_TIME_BUDGET_MS} ms)")
+        for cumulative, name in runs[-1][1]:
+            print(f"    {cumulative:8.1f} ms  {name.strip()}")
+        if import_time > IMPORT_TIME_BUDGET_MS:
+            failures.append(f"{module} takes {import_time:.0f} ms to import")
+
+        eager_imports = find_eager_imports(module)
+        if eager_imports:
+            failures.append(f"{module} imports {', '.join(eager_imports)} at startup")
+
+        if args.ui:
+            ui_startup = measure_ui_startup(module)
+            if ui_startup is None:
+                print(f"{module}: could not build the window, skipping the UI measurement")
+            else:
+                ui_time, startup_imports = ui_startup
+                print(f"{module}: window drawn after {ui_time:.0f} ms (budget {UI_STARTUP_BUDGET_MS} ms)")
+                if ui_time > UI_STARTUP_BUDGET_MS:
+                    failures.append(f"{module} takes {ui_time:.0f} ms to show its window")
+                if startup_imports:
+                    failures.append(f"{module} imports {', '.join(startup_imports)} before its window is shown")
+
+    for failure in failures:
+        print(f"Over budget: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
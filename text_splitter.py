@@ -1,50 +1,270 @@
 import os
-import tkinter as tk
-from tkinter import filedialog
-import tiktoken
-
-
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
-    """Returns the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += len(encoding.encode(message))
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        print("num_tokens calculated:", num_tokens)
-        return num_tokens
-    else:
-        raise NotImplementedError(f"""num_tokens_from_messages() is not presently implemented for model {model}.""")
+import sys
+import codecs
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from token_engine import get_encoding, iter_encoded, split_at_safe_boundaries
+
+MODEL = "gpt-3.5-turbo-0301"
+SEPARATOR = "\n\n---------divider---------\n\n"
+READ_SIZE = 1 << 20  # characters read from the input file at a time
+MAX_SEGMENT_SIZE = 1 << 22  # characters a line may grow to before it is cut without a safe boundary
+OUTPUT_SUFFIX = "--divided.txt"
+METADATA_SUFFIX = "--chunks.jsonl"
+WINDOW_LOOKAHEAD = 8  # tokens read past the end of a token window, more than the bytes in any character
+
+"""
+Chunks are dictionaries with the chunk text and where it came from in the source:
+    text:        the text of the chunk
+    byte_start:  offset of the first byte of the chunk in the source file (past its byte order mark, if it has one)
+    byte_end:    offset just past the last byte of the chunk
+    token_start: offset of the first token of the chunk in the encoded source
+    token_end:   offset just past the last token of the chunk
+    token_count: the number of tokens in the chunk text when it is encoded on its own
+"""
+
+
+def split_text(text, max_tokens=8000, separator=SEPARATOR, model=MODEL):
+    """
+    Splits text into blocks of at most max_tokens tokens and joins them with separator.
+
+    The text is cut into segments at line breaks that are safe token boundaries, and every segment is encoded once, so
+    the token count of a block is exactly the sum of the counts of its segments. Blocks are packed in a single pass. A
+    segment that is longer than max_tokens on its own is cut into token windows. Each block keeps the line break it
+    ends with, so removing the separators gives back the original text.
+    """
+    return separator.join(chunk["text"] for chunk in iter_line_chunks(text, max_tokens, model))
+
 
+def iter_line_chunks(text, max_tokens=8000, model=MODEL):
+    """Yield chunks of whole lines of at most max_tokens tokens, cutting lines that do not fit into token windows."""
+    segments = (segment for segment in split_at_safe_boundaries(text) if segment)
+    return pack_segments(segments, max_tokens, model)
 
-def split_text(text, max_tokens=8000, separator="\n\n---------divider---------\n\n"):
-    blocks = []
+
+def iter_token_chunks(text, window=8000, overlap=0, model=MODEL):
+    """Yield chunks of text cut from its token array, window tokens at a time. See window_segments."""
+    return window_segments([text], window, overlap, model)
+
+
+def pack_segments(segments, max_tokens=8000, model=MODEL):
+    """
+    Yield chunks of at most max_tokens tokens packed from an iterable of segments cut at safe token boundaries, cutting
+    segments that do not fit into token windows.
+
+    Each chunk is yielded as soon as it is complete, so only one block of segments is held in memory at a time.
+    """
     current_block = []
     current_tokens = 0
+    byte_start = 0
+    token_start = 0
 
-    messages = text.split("\n")
-    for message in messages:
-        num_tokens = num_tokens_from_messages([message])
-        if current_tokens + num_tokens > max_tokens:
-            blocks.append("\n".join(current_block))
-            current_block = [message]
-            current_tokens = num_tokens
-        else:
-            current_block.append(message)
-            current_tokens += num_tokens
+    def finish_block():
+        block = "".join(current_block)
+        return {
+            "text": block,
+            "byte_start": byte_start,
+            "byte_end": byte_start + len(block.encode("utf-8")),
+            "token_start": token_start,
+            "token_end": token_start + current_tokens,
+            "token_count": current_tokens,
+        }
+
+    for segment, tokens in iter_encoded(segments, model):
+        num_tokens = len(tokens)
+        if current_block and current_tokens + num_tokens > max_tokens:
+            chunk = finish_block()
+            yield chunk
+            byte_start, token_start = chunk["byte_end"], chunk["token_end"]
+            current_block = []
+            current_tokens = 0
+
+        if num_tokens > max_tokens:
+            # A line that does not fit in a block on its own is cut into token windows
+            for chunk in window_segments([segment], max_tokens, 0, model):
+                chunk["byte_start"] += byte_start
+                chunk["byte_end"] += byte_start
+                chunk["token_start"] += token_start
+                chunk["token_end"] += token_start
+                yield chunk
+            byte_start += len(segment.encode("utf-8"))
+            token_start += num_tokens
+            continue
+
+        current_block.append(segment)
+        current_tokens += num_tokens
 
     if current_block:
-        blocks.append("\n".join(current_block))
+        yield finish_block()
+
+
+def window_segments(segments, window=8000, overlap=0, model=MODEL):
+    """
+    Yield chunks cut from the token array of an iterable of segments, window tokens at a time, with each chunk repeating
+    the last overlap tokens of the one before it.
+
+    Cuts are moved back to the nearest character boundary, and a chunk is shortened when encoding its text on its own
+    comes to more than window tokens. A chunk is only over the window when there is no character boundary inside it.
+    Segments are encoded as they are needed and tokens are dropped once they are behind the next chunk, so only about
+    one window of tokens is held in memory at a time.
+    """
+    if window < 1 or not 0 <= overlap < window:
+        raise ValueError("The window must be at least 1 token and the overlap must be between 0 and the window.")
+
+    encoding = get_encoding(model)
+    encoded_segments = iter_encoded(segments, model)
+    tokens = []  # the tokens from token_offset on
+    token_offset = 0
+    byte_offset = 0
+    exhausted = False
+
+    while True:
+        # Read a few tokens past the window, so a cut inside a character can be moved forward if it has to be
+        while not exhausted and len(tokens) <= window + WINDOW_LOOKAHEAD:
+            try:
+                tokens.extend(next(encoded_segments)[1])
+            except StopIteration:
+                exhausted = True
+        if not tokens:
+            return
+
+        end = utf8_boundary(encoding, tokens, min(window, len(tokens)))
+        while True:
+            chunk_bytes = encoding.decode_bytes(tokens[:end])
+            chunk_text = chunk_bytes.decode("utf-8")
+            token_count = len(encoding.encode(chunk_text, disallowed_special=()))
+            excess = token_count - window
+            if excess <= 0 or end <= excess:
+                break
+            shorter_end = utf8_boundary(encoding, tokens, end - excess)
+            if shorter_end >= end:
+                break
+            end = shorter_end
+
+        yield {
+            "text": chunk_text,
+            "byte_start": byte_offset,
+            "byte_end": byte_offset + len(chunk_bytes),
+            "token_start": token_offset,
+            "token_end": token_offset + end,
+            "token_count": token_count,
+        }
+        if exhausted and end == len(tokens):
+            return
+
+        next_start = utf8_boundary(encoding, tokens, end - overlap)
+        if next_start <= 0:
+            next_start = end
+        byte_offset += len(encoding.decode_bytes(tokens[:next_start]))
+        token_offset += next_start
+        del tokens[:next_start]
+
+
+def utf8_boundary(encoding, tokens, index, lower_bound=0):
+    """
+    Return the nearest token offset at or before index, and after lower_bound, that does not fall inside a multi-byte
+    character. When there is none, the nearest such offset after index is returned instead.
+    """
+    def inside_character(offset):
+        return 0 < offset < len(tokens) and 0x80 <= encoding.decode_single_token_bytes(tokens[offset])[0] < 0xC0
+
+    boundary = index
+    while boundary > lower_bound and inside_character(boundary):
+        boundary -= 1
+    if boundary > lower_bound:
+        return boundary
+    boundary = index
+    while inside_character(boundary):
+        boundary += 1
+    return boundary
+
 
-    return separator.join(blocks)
+def iter_file_segments(file, read_size=READ_SIZE, max_segment_size=MAX_SEGMENT_SIZE):
+    """
+    Yield the text of an open file in segments cut at safe token boundaries, reading read_size characters at a time.
 
+    A segment that grows past max_segment_size characters without a safe boundary is cut before its last space instead,
+    so memory stays bounded for files with very long lines. The token counts of the pieces may then be a token or two
+    off the count of the uncut line.
+    """
+    pending = ""
+    while True:
+        text = file.read(read_size)
+        if not text:
+            break
+        segments = split_at_safe_boundaries(pending + text)
+        # The last segment may go on in the next read. When it is only whitespace, whether the boundary before it is
+        # safe depends on what follows, so the segment before it is held back as well.
+        pending = segments.pop()
+        if segments and not pending.strip():
+            pending = segments.pop() + pending
+        while len(pending) > max_segment_size:
+            cut = pending.rfind(" ", 1, max_segment_size)
+            if cut < 1:
+                cut = max_segment_size
+            segments.append(pending[:cut])
+            pending = pending[cut:]
+        yield from segments
+    # At the end of the file every boundary is known, so whatever was held back is split again
+    yield from (segment for segment in split_at_safe_boundaries(pending) if segment)
+
+
+def write_chunks(chunks, output_path, metadata_path, separator=SEPARATOR):
+    """Write the chunk texts joined by separator to output_path and one JSON line of metadata per chunk to
+    metadata_path. Returns the number of chunks written."""
+    num_chunks = 0
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file, \
+            open(metadata_path, "w", encoding="utf-8") as metadata_file:
+        for chunk in chunks:
+            if num_chunks:
+                output_file.write(separator)
+            output_file.write(chunk["text"])
+            metadata = {key: value for key, value in chunk.items() if key != "text"}
+            metadata["chunk"] = num_chunks
+            metadata_file.write(json.dumps(metadata) + "\n")
+            num_chunks += 1
+    return num_chunks
+
+
+def shift_chunks(chunks, byte_offset):
+    """Yield chunks with their byte offsets moved byte_offset bytes further into the source."""
+    for chunk in chunks:
+        yield dict(chunk, byte_start=chunk["byte_start"] + byte_offset, byte_end=chunk["byte_end"] + byte_offset)
+
+
+def split_file(input_path, output_path, metadata_path, mode="lines", max_tokens=8000, overlap=0):
+    """
+    Split the text file at input_path into output_path, with the chunk metadata in metadata_path, and return the number
+    of chunks. The input is read a piece at a time and each chunk is written as soon as it is complete, so files far
+    larger than memory can be split.
+
+    Line endings are kept as they are in the file, and a UTF-8 byte order mark is left out of the chunks but counted in
+    their byte offsets, so byte_start and byte_end always point at the chunk in the file itself.
+    """
+    with open(input_path, "rb") as file:
+        bom_size = len(codecs.BOM_UTF8) if file.read(len(codecs.BOM_UTF8)) == codecs.BOM_UTF8 else 0
+    with open(input_path, "r", encoding="utf-8-sig", newline="") as file:
+        segments = iter_file_segments(file)
+        if mode == "tokens":
+            chunks = window_segments(segments, max_tokens, overlap)
+        else:
+            chunks = pack_segments(segments, max_tokens)
+        return write_chunks(shift_chunks(chunks, bom_size), output_path, metadata_path)
+
+
+def main(mode="lines", max_tokens=8000, overlap=0):
+    """
+    Splits a text file chosen in a file dialog.
+
+    In "lines" mode, blocks of whole lines are packed up to max_tokens tokens. In "tokens" mode, the token array is cut
+    into windows of max_tokens tokens that overlap by overlap tokens.
+    """
+    # Tk is only needed for the file dialog, so the command line splitter also runs on Pythons built without it
+    import tkinter as tk
+    from tkinter import filedialog
 
-def main():
     root = tk.Tk()
     root.withdraw()
 
@@ -53,18 +273,122 @@ def main():
         print("No file selected.")
         return
 
-    with open(file_path, "r", encoding="utf-8") as file:
-        text = file.read()
+    new_file_path, metadata_file_path = output_paths(file_path)
+    num_chunks = split_file(file_path, new_file_path, metadata_file_path, mode, max_tokens, overlap)
 
-    divided_text = split_text(text)
+    print(f"Divided text saved to: {new_file_path} ({num_chunks} chunks)")
+    print(f"Chunk metadata saved to: {metadata_file_path}")
+    print("---------divider---------")
 
-    new_file_path = os.path.splitext(file_path)[0] + "--divided.txt"
-    with open(new_file_path, "w", encoding="utf-8") as file:
-        file.write(divided_text)
 
-    print(f"Divided text saved to: {new_file_path}")
-    print("---------divider---------")
+def output_paths(input_path, output_dir=None, relative_path=None):
+    """
+    Return the paths of the divided text and the chunk metadata for input_path. They are written next to the source
+    unless output_dir is given, in which case relative_path (the file name by default) is kept under output_dir.
+    """
+    if output_dir is None:
+        base = os.path.splitext(input_path)[0]
+    else:
+        base = os.path.join(output_dir, os.path.splitext(relative_path or os.path.basename(input_path))[0])
+    return base + OUTPUT_SUFFIX, base + METADATA_SUFFIX
+
+
+def glob_root(pattern):
+    """Return the directory a glob pattern searches under: its leading directories that contain no wildcards."""
+    root = pattern
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+
+def find_input_files(paths, pattern="*.txt", recursive=False):
+    """
+    Return (input path, path relative to the directory or glob it was found under) for every file named by paths.
+
+    Each path may be a file, a directory (searched for files matching pattern) or a glob. Files written by the splitter
+    itself are skipped, so a directory can be split again without picking up its own output.
+    """
+    input_files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            matches = glob.glob(os.path.join(path, "**", pattern) if recursive else os.path.join(path, pattern),
+                                recursive=recursive)
+            root = path
+        elif glob.has_magic(path):
+            matches = glob.glob(path, recursive=True)
+            root = glob_root(path)
+        else:
+            matches = [path]
+            root = None
+        for match in sorted(matches):
+            if not os.path.isfile(match) or match.endswith((OUTPUT_SUFFIX, METADATA_SUFFIX)):
+                continue
+            relative_path = os.path.relpath(match, root) if root else os.path.basename(match)
+            input_files.setdefault(os.path.abspath(match), relative_path)
+    return list(input_files.items())
+
+
+def cli(args=None):
+    """
+    Splits files named on the command line, spread over a pool of worker processes. Returns the number of files that
+    could not be split.
+    """
+    parser = argparse.ArgumentParser(description="Split text files into blocks that fit a model's context window.")
+    parser.add_argument("paths", nargs="+", help="files, directories or glob patterns to split")
+    parser.add_argument("-o", "--output-dir", help="directory to write to (default: next to each source file)")
+    parser.add_argument("--mode", choices=["lines", "tokens"], default="lines",
+                        help="pack whole lines into blocks, or cut the token array into windows (default: lines)")
+    parser.add_argument("--max-tokens", type=int, default=8000, help="tokens per block or window (default: 8000)")
+    parser.add_argument("--overlap", type=int, default=0, help="tokens repeated between windows in tokens mode")
+    parser.add_argument("--pattern", default="*.txt", help="files to pick up in directories (default: *.txt)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="search directories recursively")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: one per CPU)")
+    args = parser.parse_args(args)
+    if args.max_tokens < 1 or not 0 <= args.overlap < args.max_tokens:
+        parser.error("--max-tokens must be at least 1 and --overlap must be between 0 and --max-tokens")
+
+    input_files = find_input_files(args.paths, args.pattern, args.recursive)
+    if not input_files:
+        print("No files to split.")
+        return 0
+    if args.output_dir is not None:
+        # Files from different places can map to the same output path, and would overwrite each other's output
+        sources = {}
+        for input_path, relative_path in input_files:
+            sources.setdefault(output_paths(input_path, args.output_dir, relative_path)[0], []).append(input_path)
+        collisions = [paths for paths in sources.values() if len(paths) > 1]
+        if collisions:
+            parser.error("these files would be written to the same place under the output directory: "
+                         + "; ".join(", ".join(paths) for paths in collisions))
+
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for input_path, relative_path in input_files:
+            output_path, metadata_path = output_paths(input_path, args.output_dir, relative_path)
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            future = executor.submit(split_file, input_path, output_path, metadata_path, args.mode, args.max_tokens,
+                                     args.overlap)
+            futures[future] = (input_path, output_path)
+
+        for number, future in enumerate(as_completed(futures), start=1):
+            input_path, output_path = futures[future]
+            try:
+                num_chunks = future.result()
+            except Exception as e:
+                num_failed += 1
+                print(f"[{number}/{len(futures)}] Could not split {input_path}: {e}")
+            else:
+                print(f"[{number}/{len(futures)}] {input_path} -> {output_path} ({num_chunks} chunks)")
+
+    print(f"Split {len(futures) - num_failed} of {len(futures)} files.")
+    return num_failed
 
 
 if __name__ == "__main__":
-    main()
+    # With arguments the splitter runs headless, without them a file is chosen in a dialog
+    if len(sys.argv) > 1:
+        sys.exit(1 if cli() else 0)
+    else:
+        main()
@@ -1,31 +1,21 @@
+import os
+import sqlite3
 import tkinter as tk
-from tkinter import scrolledtext, messagebox
-import tiktoken
+from tkinter import scrolledtext, messagebox, filedialog
+import numpy as np
+from background_task import BackgroundTask
+from token_engine import IncrementalTokenCounter, TokenCountCache, get_encoding, preload_encodings, CONTEXT_WINDOWS, \
+    MODEL_PRICES
 
+MODEL = "gpt-3.5-turbo-0301"
+LIVE_COUNT_DELAY_MS = 300  # Wait this long after the last edit before recounting
+CORPUS_BATCH_SIZE = 256  # Files read and counted at a time in corpus statistics mode
+PERCENTILES = [50, 75, 90, 95, 99]
 
-def num_tokens_from_string(string: str, encoding_name: str) -> int:
-    """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string, disallowed_special=()))  # Added the argument here
-    return num_tokens
-
-
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0301"):
-    # Returns the number of tokens used by a list of messages.
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo-0301":  # note: future models may deviate from this
-        num_tokens = 0
-        for message in messages:
-            num_tokens += 4  # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += len(encoding.encode(message, disallowed_special=()))  # Added the argument here
-        num_tokens += 2  # every reply is primed with <im_start>assistant
-        print("num_tokens calculated:", num_tokens)
-        return num_tokens
-    else:
-        raise NotImplementedError(f"num_tokens_from_messages() is not presently implemented for model {model}.")
+# Load the tokenizer while the window is built
+preload_encodings([MODEL])
+token_counter = IncrementalTokenCounter(MODEL)
+live_count_job = None
 
 
 # Function to count the tokens
@@ -37,13 +27,193 @@ def count_tokens():
     if user_input.strip() == "":
         messagebox.showwarning("Warning", "Please enter some text.")
     else:
-        # Call the existing function to count the tokens
-        num_tokens = num_tokens_from_messages([user_input])
+        # Only the paragraphs changed since the last count are encoded again
+        num_tokens = token_counter.count_message(user_input)
 
         # Display the number of tokens in the result area
         result_area.configure(text=f"Number of tokens: {num_tokens}")
 
 
+# Function to recount the tokens once the text has stopped changing
+def schedule_live_count(event=None):
+    global live_count_job
+
+    # The <<Modified>> event also fires when the modified flag is reset below
+    if not text_box.edit_modified():
+        return
+    text_box.edit_modified(False)
+
+    if not live_count.get():
+        return
+    if live_count_job is not None:
+        window.after_cancel(live_count_job)
+    live_count_job = window.after(LIVE_COUNT_DELAY_MS, run_live_count)
+
+
+def run_live_count():
+    global live_count_job
+    live_count_job = None
+
+    num_tokens = token_counter.count_message(text_box.get("1.0", tk.END))
+    result_area.configure(text=f"Number of tokens: {num_tokens}")
+
+
+def toggle_live_count():
+    global live_count_job
+
+    if live_count.get():
+        run_live_count()
+    elif live_count_job is not None:
+        window.after_cancel(live_count_job)
+        live_count_job = None
+
+
+# Function to read a corpus file, or None if it is not UTF-8 text
+def read_text_file(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    # Binary files such as images and archives contain NUL bytes, which text practically never does
+    if b"\0" in data:
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+# Function to count the tokens in every file under a directory
+def count_corpus_tokens(directory, task=None):
+    """
+    Returns the paths of the text files under directory, relative to it, a NumPy array of their token counts, and the
+    paths of the files that were skipped because they are not UTF-8 text or could not be read. When run by a
+    background task, the number of files done so far is reported after each batch, and counting stops early if the
+    task is cancelled.
+    """
+    all_paths = sorted(os.path.relpath(os.path.join(folder, file_name), directory)
+                       for folder, _, file_names in os.walk(directory) for file_name in file_names)
+
+    encoding = get_encoding(MODEL)
+    try:
+        cache = TokenCountCache()
+    except sqlite3.Error as e:
+        print(f"Warning: could not open the token count cache, counting without it: {e}")
+        cache = None
+
+    paths = []
+    counts = []
+    skipped = []
+    for start in range(0, len(all_paths), CORPUS_BATCH_SIZE):
+        if task is not None and task.cancelled:
+            break
+        texts = []
+        for path in all_paths[start:start + CORPUS_BATCH_SIZE]:
+            try:
+                text = read_text_file(os.path.join(directory, path))
+            except OSError as e:
+                print(f"Skipping {path}: {e}")
+                text = None
+            if text is None:
+                skipped.append(path)
+                continue
+            paths.append(path)
+            texts.append(text)
+        if cache is not None:
+            counts.extend(cache.count_strings(texts, encoding))
+        else:
+            counts.extend(len(tokens) for tokens in encoding.encode_batch(texts, disallowed_special=()))
+        if task is not None:
+            task.report(min(start + CORPUS_BATCH_SIZE, len(all_paths)), len(all_paths))
+
+    if cache is not None:
+        cache.close()
+    return paths, np.array(counts, dtype=np.int64), skipped
+
+
+# Function to describe the distribution of token counts in a corpus
+def corpus_statistics_report(directory, paths, counts, skipped=()):
+    lines = [f"Corpus: {directory}", f"Files: {len(counts)}"]
+    if skipped:
+        lines.append(f"Skipped: {len(skipped)} files that could not be read as UTF-8 text (listed at the end)")
+    if not len(counts):
+        return "\n".join(lines + [f"  {path}" for path in skipped])
+
+    lines.append(f"Total tokens: {counts.sum()}")
+    lines.append(f"Mean: {counts.mean():.0f}  Min: {counts.min()}  Max: {counts.max()} ({paths[counts.argmax()]})")
+    percentiles = np.percentile(counts, PERCENTILES)
+    lines.append("Percentiles: " + "  ".join(f"p{p}: {value:.0f}" for p, value in zip(PERCENTILES, percentiles)))
+
+    # Bucket every file by the smallest context window it fits in
+    windows = np.unique(list(CONTEXT_WINDOWS.values()))
+    buckets = np.bincount(np.searchsorted(windows, counts), minlength=len(windows) + 1)
+    lines.append("")
+    lines.append("Files by the smallest context window they fit in:")
+    lower_bounds = np.concatenate(([-1], windows))
+    for lower, upper, num_files in zip(lower_bounds, windows, buckets):
+        lines.append(f"  {lower + 1:>7} - {upper:>7} tokens: {num_files:>7} ({num_files / len(counts):6.1%})")
+    lines.append(f"  {'over':>7} {windows[-1]:>9} tokens: {buckets[-1]:>7} ({buckets[-1] / len(counts):6.1%})")
+
+    # Files that do not fit in a model's context window have to be split before they can be sent
+    lines.append("")
+    lines.append("Projected prompt cost per model, with over-length files split into chunks of the context window:")
+    for model, window in CONTEXT_WINDOWS.items():
+        over_length = np.count_nonzero(counts > window)
+        num_chunks = np.ceil(counts / window).astype(np.int64).clip(min=1).sum()
+        line = f"  {model:<24} {window:>7} tokens  {over_length:>7} files over  {num_chunks:>7} chunks"
+        if model in MODEL_PRICES:
+            line += f"  ${counts.sum() / 1000 * MODEL_PRICES[model]['prompt']:,.2f}"
+        lines.append(line)
+
+    if skipped:
+        lines.append("")
+        lines.append("Skipped files:")
+        lines.extend(f"  {path}" for path in skipped)
+    return "\n".join(lines)
+
+
+# Function to show the token statistics of a directory of files
+def show_corpus_statistics():
+    directory = filedialog.askdirectory(title="Select a corpus directory")
+    if not directory:
+        return
+
+    # The files are read and counted on a worker thread, so the window stays responsive on large corpora
+    result_area.configure(text="Counting the tokens in the corpus...")
+    corpus_button.configure(state="disabled")
+    BackgroundTask(window, lambda task: count_corpus_tokens(directory, task),
+                   on_progress=show_corpus_progress,
+                   on_done=lambda result: show_corpus_report(directory, *result),
+                   on_error=corpus_count_failed).start()
+
+
+# Function to show how far the corpus count has got
+def show_corpus_progress(num_done, num_files):
+    result_area.configure(text=f"Counting the tokens in the corpus... {num_done} of {num_files} files")
+
+
+# Function to report a corpus count that failed
+def corpus_count_failed(error):
+    corpus_button.configure(state="normal")
+    print(f"Error while counting the corpus: {error}")
+    result_area.configure(text="Number of tokens: ")
+    messagebox.showerror("Error", f"The corpus could not be counted: {error}")
+
+
+# Function to show the statistics of a counted corpus
+def show_corpus_report(directory, paths, counts, skipped):
+    corpus_button.configure(state="normal")
+    report = corpus_statistics_report(directory, paths, counts, skipped)
+    print(report)
+    result_area.configure(text=f"Number of tokens in the corpus: {counts.sum()}")
+
+    # Show the report in a window of its own
+    report_window = tk.Toplevel(window)
+    report_window.title("Corpus Token Statistics")
+    report_text = scrolledtext.ScrolledText(report_window, width=110, height=35, padx=10, pady=10)
+    report_text.insert("1.0", report)
+    report_text.configure(state="disabled")
+    report_text.pack(fill="both", expand=True)
+
+
 # Create the main window
 window = tk.Tk()
 
@@ -62,6 +232,10 @@ text_box = scrolledtext.ScrolledText(window, width=70, height=30, padx=10, pady=
 # Set the text box properties
 text_box.pack()
 
+# Recount the tokens as the text is edited when live counting is on
+live_count = tk.BooleanVar(value=False)
+text_box.bind("<<Modified>>", schedule_live_count)
+
 # Create the button frame
 button_frame = tk.Frame(window)
 
@@ -74,10 +248,18 @@ clear_button = tk.Button(button_frame, text="Clear the text box", command=lambda
 # Create the Cancel button
 cancel_button = tk.Button(button_frame, text="Cancel", command=window.destroy)
 
+# Create the Corpus statistics button
+corpus_button = tk.Button(button_frame, text="Corpus statistics", command=show_corpus_statistics)
+
+# Create the Live count check box
+live_count_checkbox = tk.Checkbutton(button_frame, text="Live count", variable=live_count, command=toggle_live_count)
+
 # Add the buttons to the button frame
 submit_button.pack(side="left", padx=10, pady=10)
 clear_button.pack(side="left", padx=10, pady=10)
 cancel_button.pack(side="left", padx=10, pady=10)
+corpus_button.pack(side="left", padx=10, pady=10)
+live_count_checkbox.pack(side="left", padx=10, pady=10)
 
 # Add the button frame to the main window
 button_frame.pack()
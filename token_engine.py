@@ -0,0 +1,591 @@
+import os
+import re
+import sys
+import shutil
+import json
+import math
+import base64
+import struct
+import hashlib
+import sqlite3
+import functools
+import itertools
+import threading
+from model_registry import registry
+
+"""
+Shared token counting for the OpenAI tools.
+
+Encodings are resolved once per model and cached for the life of the process, so repeated counts (one per source file
+in a batch run, one per recount in the GUIs) never repeat the tiktoken lookup. The tokenizer, message overheads,
+context window and prices of each model come from the model registry (see model_registry.py); model names that are not
+in it are counted as the model their family is mapped to by MODEL_ALIASES.
+"""
+
+# tiktoken is imported where an encoding is first loaded rather than here: it is one of the slow imports on the startup
+# path of the GUIs, and preload_encodings loads it on a background thread while the window is built.
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# Per-user directory for files the tools keep between runs
+CACHE_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+                         or os.path.expanduser(os.path.join("~", ".cache")), "LLM_Tools")
+TOKEN_COUNT_CACHE_PATH = os.path.join(CACHE_DIR, "token_counts.sqlite3")
+
+# tiktoken downloads the BPE files of an encoding the first time it is used and keeps them in TIKTOKEN_CACHE_DIR. The
+# files are shipped with the tools in resources/tiktoken (run this module to fetch them again), and are copied into the
+# per-user cache so that no download is needed. PyInstaller builds unpack their data files into sys._MEIPASS.
+BUNDLED_TIKTOKEN_DIR = os.path.join(getattr(sys, "_MEIPASS", os.path.dirname(os.path.abspath(__file__))),
+                                    "resources", "tiktoken")
+TIKTOKEN_CACHE_DIR = os.path.join(CACHE_DIR, "tiktoken")
+PRELOAD_ENCODINGS = [DEFAULT_ENCODING]
+
+# Views of the model registry, updated in place when it is reloaded.
+# MODEL_RULES holds the tokens added by the API for every message and for a message's "name" field.
+# See https://github.com/openai/openai-python/blob/main/chatml.md for how messages are converted to tokens.
+MODEL_RULES = registry.message_rules
+# Model families that may update over time, and the model their unknown members are counted as
+MODEL_ALIASES = registry.families
+# Context window size of each model, in tokens
+CONTEXT_WINDOWS = registry.context_windows
+# Price of each model in US dollars per 1,000 prompt tokens and per 1,000 completion tokens.
+# See https://openai.com/pricing
+MODEL_PRICES = registry.prices
+
+REPLY_PRIMING_TOKENS = 3  # every reply is primed with <|start|>assistant<|message|>
+FUNCTION_CALL_TOKENS = 3  # added for the function call in a message
+TOOLS_TOKENS = 9  # added for the function definitions of a request
+TOOLS_SYSTEM_MESSAGE_TOKENS = -4  # the function definitions share the header of the system message when there is one
+
+# Images are billed by detail level. At low detail an image costs a fixed number of tokens; at high detail it is scaled
+# to fit in 2048 x 2048, then down until its shortest side is 768, and it costs that plus a number per 512 x 512 tile.
+# See https://platform.openai.com/docs/guides/vision
+IMAGE_LOW_DETAIL_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+IMAGE_MAX_SIZE = 2048
+IMAGE_SHORT_SIDE = 768
+
+
+def configure_tiktoken_cache():
+    """
+    Point tiktoken at the per-user cache and copy the bundled tokenizer files into it. A TIKTOKEN_CACHE_DIR that is
+    already set in the environment is left alone.
+    """
+    if "TIKTOKEN_CACHE_DIR" in os.environ:
+        return
+    os.environ["TIKTOKEN_CACHE_DIR"] = TIKTOKEN_CACHE_DIR
+    if not os.path.isdir(BUNDLED_TIKTOKEN_DIR):
+        return
+    try:
+        os.makedirs(TIKTOKEN_CACHE_DIR, exist_ok=True)
+        for file_name in os.listdir(BUNDLED_TIKTOKEN_DIR):
+            if not os.path.exists(os.path.join(TIKTOKEN_CACHE_DIR, file_name)):
+                shutil.copyfile(os.path.join(BUNDLED_TIKTOKEN_DIR, file_name),
+                                os.path.join(TIKTOKEN_CACHE_DIR, file_name))
+    except OSError as e:
+        # The bundled files can still be read where they are
+        print(f"Warning: could not copy the tokenizer files to {TIKTOKEN_CACHE_DIR}: {e}")
+        os.environ["TIKTOKEN_CACHE_DIR"] = BUNDLED_TIKTOKEN_DIR
+
+
+configure_tiktoken_cache()
+
+
+def download_tokenizer_files(encodings=PRELOAD_ENCODINGS, directory=BUNDLED_TIKTOKEN_DIR):
+    """
+    Download the tiktoken files of encodings into directory, to be shipped with the tools. This has to run before any
+    encoding is loaded in the process, which is why it is run as this module's main program.
+    """
+    import tiktoken
+    os.environ["TIKTOKEN_CACHE_DIR"] = directory
+    for encoding_name in encodings:
+        tiktoken.get_encoding(encoding_name)
+        print(f"Saved the {encoding_name} tokenizer files in {directory}")
+
+
+def preload_encodings(models=(), encodings=PRELOAD_ENCODINGS):
+    """
+    Load encodings, and the encodings of models, in a background thread, so they are ready by the time the first
+    count is made. Returns the thread.
+    """
+    def preload():
+        try:
+            import tiktoken
+            for encoding_name in encodings:
+                tiktoken.get_encoding(encoding_name)
+            for model in models:
+                get_encoding(model)
+        except Exception as e:
+            print(f"Warning: could not preload the tokenizer: {e}")
+
+    thread = threading.Thread(target=preload, name="preload_encodings", daemon=True)
+    thread.start()
+    return thread
+
+
+@functools.lru_cache(maxsize=None)
+def resolve_model(model):
+    """Return the model name whose rules in MODEL_RULES apply to the given model."""
+    if model in MODEL_RULES:
+        return model
+    for family, snapshot in MODEL_ALIASES.items():
+        if family in model:
+            print(f"Warning: {family} may update over time. Returning num tokens assuming {snapshot}.")
+            return snapshot
+    raise NotImplementedError(
+        f"""num_tokens_from_messages() is not implemented for model {model}
+        . See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are
+         converted to tokens."""
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model, resolving it only once per process."""
+    import tiktoken
+    if model in registry.models:
+        return tiktoken.get_encoding(registry.tokenizer(model))
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print(f"Warning: model {model} not found. Using {DEFAULT_ENCODING} encoding.")
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def clear_model_caches():
+    """Forget the models and encodings resolved from the old entries of a reloaded model registry."""
+    resolve_model.cache_clear()
+    get_encoding.cache_clear()
+
+
+registry.on_reload(clear_model_caches)
+
+
+def num_tokens_from_value(value, encoding):
+    """Return the number of tokens in a single message field."""
+    if isinstance(value, str):
+        # Encode strings
+        return len(encoding.encode(value, disallowed_special=()))
+    elif value is None:
+        # Fields that are not set, such as the content of a message with only tool calls, are not sent
+        return 0
+    elif isinstance(value, (int, float)):
+        # Convert numbers to strings
+        return len(encoding.encode(str(value)))
+    elif isinstance(value, list):
+        # Content parts and tool calls are counted one by one
+        return sum(num_tokens_from_value(item, encoding) for item in value)
+    elif isinstance(value, dict):
+        return num_tokens_from_structure(value, encoding)
+    else:
+        # For other types, try converting to string
+        try:
+            return len(encoding.encode(str(value), disallowed_special=()))
+        except Exception:
+            print(f"Could not handle value: {value}")
+            return 0
+
+
+def num_tokens_from_structure(value, encoding):
+    """Return the number of tokens in a content part, a function or tool call, or any other dictionary field."""
+    if value.get("type") == "text":
+        return num_tokens_from_value(value.get("text", ""), encoding)
+    elif value.get("type") == "image_url":
+        image_url = value.get("image_url", {})
+        if isinstance(image_url, str):
+            image_url = {"url": image_url}
+        return num_tokens_from_image(image_url.get("url", ""), image_url.get("detail", "auto"))
+    elif isinstance(value.get("function"), dict):
+        # A tool call wraps a function call
+        return num_tokens_from_structure(value["function"], encoding)
+    elif "name" in value and "arguments" in value:
+        # The name and the JSON arguments of a function call are sent as they are
+        return (num_tokens_from_value(value["name"], encoding) + num_tokens_from_value(value["arguments"], encoding)
+                + FUNCTION_CALL_TOKENS)
+    else:
+        # Anything else is sent serialized as JSON
+        return len(encoding.encode(json.dumps(value), disallowed_special=()))
+
+
+def num_tokens_from_image(url, detail="auto"):
+    """
+    Return the number of tokens an image in a message costs.
+
+    The size of the image is read from data URLs. For images that are only linked, the size is not known, and the
+    largest number of tiles a high detail image can have is assumed, so budgets are never too small.
+    """
+    if detail == "low":
+        return IMAGE_LOW_DETAIL_TOKENS
+
+    size = image_size_from_data_url(url)
+    if size is None:
+        width, height = IMAGE_MAX_SIZE, IMAGE_SHORT_SIDE
+    else:
+        width, height = size
+        scale = min(1, IMAGE_MAX_SIZE / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1, IMAGE_SHORT_SIDE / min(width, height))
+        width, height = width * scale, height * scale
+    tiles = math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+    return IMAGE_LOW_DETAIL_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def image_size_from_data_url(url):
+    """Return the (width, height) of a PNG, GIF or JPEG image in a base64 data URL, or None if it cannot be read."""
+    if not url.startswith("data:") or ";base64," not in url:
+        return None
+    try:
+        data = base64.b64decode(url.split(";base64,", 1)[1])
+        if data.startswith(b"\x89PNG\r\n\x1a\n"):
+            return struct.unpack(">II", data[16:24])
+        if data[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", data[6:10])
+        if data.startswith(b"\xff\xd8"):
+            # Walk the JPEG segments up to the start of frame, which holds the size
+            position = 2
+            while position + 9 < len(data):
+                marker = data[position + 1]
+                length = struct.unpack(">H", data[position + 2:position + 4])[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", data[position + 5:position + 9])
+                    return width, height
+                position += 2 + length
+    except (ValueError, struct.error, IndexError):
+        pass
+    return None
+
+
+def format_function_definitions(functions):
+    """
+    Return function definitions in the TypeScript-like form the API shows them to the model in, which is what they are
+    billed as.
+    """
+    lines = ["namespace functions {", ""]
+    for function in functions:
+        if function.get("description"):
+            lines.append(f"// {function['description']}")
+        parameters = function.get("parameters") or {}
+        if parameters.get("properties"):
+            lines.append(f"type {function['name']} = (_: {{")
+            lines.append(format_function_parameters(parameters, 0))
+            lines.append("}) => any;")
+        else:
+            lines.append(f"type {function['name']} = () => any;")
+        lines.append("")
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+def format_function_parameters(parameters, indent):
+    """Return the properties of a JSON schema object as TypeScript-like fields."""
+    lines = []
+    required = parameters.get("required", [])
+    for name, schema in parameters["properties"].items():
+        if schema.get("description") and indent < 2:
+            lines.append(f"// {schema['description']}")
+        optional = "" if name in required else "?"
+        lines.append(f"{name}{optional}: {format_function_parameter_type(schema, indent)},")
+    return "\n".join(" " * indent + line for line in lines)
+
+
+def format_function_parameter_type(schema, indent):
+    """Return the TypeScript-like type of a JSON schema."""
+    schema_type = schema.get("type")
+    if "enum" in schema:
+        return " | ".join(json.dumps(item) for item in schema["enum"])
+    elif schema_type == "string":
+        return "string"
+    elif schema_type in ("number", "integer"):
+        return "number"
+    elif schema_type in ("boolean", "null"):
+        return schema_type
+    elif schema_type == "object" and schema.get("properties"):
+        return "{\n" + format_function_parameters(schema, indent + 2) + "\n}"
+    elif schema_type == "array":
+        return format_function_parameter_type(schema.get("items", {}), indent) + "[]"
+    return "any"
+
+
+def num_tokens_from_tools(tools, model):
+    """Return the number of tokens that the function or tool definitions of a request add to the prompt."""
+    encoding = get_encoding(model)
+    # Tools are {"type": "function", "function": {...}}, the older functions parameter holds the definitions directly
+    functions = [tool["function"] if isinstance(tool.get("function"), dict) else tool for tool in tools]
+    return len(encoding.encode(format_function_definitions(functions), disallowed_special=())) + TOOLS_TOKENS
+
+
+def num_tokens_from_messages(messages, model, tools=None):
+    """Return the number of tokens used by a list of messages.
+
+    Messages are dictionaries of message fields. A plain string is counted as a message with only content. The tokens
+    of the function or tool definitions sent with the messages are added when tools is given.
+    """
+    num_tokens = 0
+    for message in messages:
+        num_tokens += num_tokens_from_message(message, model)
+    num_tokens += REPLY_PRIMING_TOKENS
+    if tools:
+        num_tokens += num_tokens_from_tools(tools, model)
+        if any(isinstance(message, dict) and message.get("role") == "system" for message in messages):
+            num_tokens += TOOLS_SYSTEM_MESSAGE_TOKENS
+    return num_tokens
+
+
+def num_tokens_from_message(message, model):
+    """Return the number of tokens used by a single message, not counting the tokens that prime the reply."""
+    rules = MODEL_RULES[resolve_model(model)]
+    encoding = get_encoding(model)
+
+    if isinstance(message, str):
+        message = {"content": message}
+    num_tokens = rules["tokens_per_message"]
+    for key, value in message.items():
+        num_tokens += num_tokens_from_value(value, encoding)
+        if key == "name":
+            num_tokens += rules["tokens_per_name"]
+    return num_tokens
+
+
+class TokenCountCache:
+    """
+    A persistent cache of token counts in an SQLite database, keyed by the SHA-256 hash of the text and the name of the
+    encoding, so the same text is only ever encoded once per encoding, across runs.
+
+    The cache can be shared between threads.
+    """
+
+    # SQLite allows at most 999 parameters in a statement in older versions
+    QUERY_BATCH_SIZE = 900
+
+    def __init__(self, path=TOKEN_COUNT_CACHE_PATH):
+        self.path = path
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_counts ("
+            "hash TEXT NOT NULL, encoding TEXT NOT NULL, num_tokens INTEGER NOT NULL, PRIMARY KEY (hash, encoding))"
+        )
+        self.connection.commit()
+
+    @staticmethod
+    def hash_text(text):
+        """Return the key a text is cached under."""
+        return hashlib.sha256(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get_many(self, hashes, encoding_name):
+        """Return a dictionary of the cached token counts of the given hashes. Hashes that are not cached are left
+        out."""
+        hashes = list(hashes)
+        found = {}
+        with self.lock:
+            for start in range(0, len(hashes), self.QUERY_BATCH_SIZE):
+                batch = hashes[start:start + self.QUERY_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT hash, num_tokens FROM token_counts WHERE encoding = ? AND hash IN "
+                    f"({', '.join('?' * len(batch))})",
+                    [encoding_name, *batch],
+                )
+                found.update(rows)
+        return found
+
+    def set_many(self, counts, encoding_name):
+        """Store a dictionary of token counts by hash."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO token_counts (hash, encoding, num_tokens) VALUES (?, ?, ?)",
+                [(text_hash, encoding_name, num_tokens) for text_hash, num_tokens in counts.items()],
+            )
+
+    def count_strings(self, strings, encoding, num_threads=8):
+        """
+        Return the token count of each string, as a list in the same order. Only strings that are not in the cache are
+        encoded, in one batch, and each distinct string is encoded only once.
+        """
+        hashes = [self.hash_text(string) for string in strings]
+        counts = self.get_many(set(hashes), encoding.name)
+
+        missing = {}
+        for text_hash, string in zip(hashes, strings):
+            if text_hash not in counts:
+                missing.setdefault(text_hash, string)
+        if missing:
+            encoded = encoding.encode_batch(list(missing.values()), num_threads=num_threads, disallowed_special=())
+            new_counts = {text_hash: len(tokens) for text_hash, tokens in zip(missing, encoded)}
+            self.set_many(new_counts, encoding.name)
+            counts.update(new_counts)
+        return [counts[text_hash] for text_hash in hashes]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def iter_encoded(strings, model, batch_size=1024, num_threads=8):
+    """Yield (string, tokens) for each string in an iterable of strings.
+
+    The strings are encoded batch_size at a time with tiktoken's batch encoder, so only one batch of strings and tokens
+    is held in memory at a time, however long the iterable is.
+    """
+    encoding = get_encoding(model)
+    strings = iter(strings)
+    while True:
+        batch = list(itertools.islice(strings, batch_size))
+        if not batch:
+            return
+        yield from zip(batch, encoding.encode_batch(batch, num_threads=num_threads, disallowed_special=()))
+
+
+# The end of a line, unless the whitespace that follows it contains another line break. The cl100k_base tokenizer used
+# by the chat models never merges characters across this point, so text split here can be encoded piece by piece and
+# the counts summed.
+SAFE_BOUNDARY_PATTERN = re.compile(r"(?<=[\r\n])(?![^\S\r\n]*[\r\n])")
+
+
+def split_at_safe_boundaries(text):
+    """Split text into segments whose token counts add up to the token count of the whole text."""
+    return SAFE_BOUNDARY_PATTERN.split(text)
+
+
+def split_at_seams(text):
+    """
+    Split text into (head, middle, tail) for counting it between other text.
+
+    The head runs up to the first safe token boundary and the tail starts at the last boundary that stays safe whatever
+    text follows, so the middle can be counted on its own. When there is no such pair of boundaries, the middle is None
+    and the head is the whole text.
+    """
+    segments = [segment for segment in split_at_safe_boundaries(text) if segment]
+    if len(segments) > 1 and not segments[-1].strip():
+        # A boundary followed only by spaces can be undone by a line break in the text that comes after it
+        segments[-2:] = ["".join(segments[-2:])]
+    if len(segments) < 2:
+        return text, None, None
+    return segments[0], "".join(segments[1:-1]), segments[-1]
+
+
+class PromptTemplate:
+    """
+    Token accounting for a prompt template whose message contents contain a placeholder that is replaced by a different
+    text for every prompt, such as the file content in a prompt test run.
+
+    The static text around the placeholders is split and counted once, when the template is created. A prompt is then
+    counted as the static total, plus the tokens of the text that replaces the placeholder, plus the tokens of the few
+    lines on either side of each seam between the two, which are encoded together because the tokenizer can merge
+    characters across a seam.
+    """
+
+    def __init__(self, messages, model, placeholder="--{?}--", cache=None):
+        rules = MODEL_RULES[resolve_model(model)]
+        self.encoding = get_encoding(model)
+        self.placeholder = placeholder
+        self.cache = cache
+
+        self.static_tokens = REPLY_PRIMING_TOKENS
+        self.message_pieces = []  # for each message content with placeholders, its static pieces split at seams
+        static_texts = []
+        for message in messages:
+            if isinstance(message, str):
+                message = {"content": message}
+            self.static_tokens += rules["tokens_per_message"]
+            for key, value in message.items():
+                if key == "name":
+                    self.static_tokens += rules["tokens_per_name"]
+                if not isinstance(value, str) or key != "content" or placeholder not in value:
+                    self.static_tokens += num_tokens_from_value(value, self.encoding)
+                    continue
+                pieces = [split_at_seams(piece) for piece in value.split(placeholder)]
+                static_texts.extend(middle for head, middle, tail in pieces if middle)
+                self.message_pieces.append(pieces)
+        self.static_tokens += sum(self.count_strings(static_texts))
+
+    def count_strings(self, strings, num_threads=8):
+        """Return the token count of each string, taking them from the cache when there is one."""
+        if self.cache is not None:
+            return self.cache.count_strings(strings, self.encoding, num_threads)
+        return [len(tokens) for tokens in
+                self.encoding.encode_batch(strings, num_threads=num_threads, disallowed_special=())]
+
+    def count(self, text):
+        """Return the number of tokens in the prompt with text in place of the placeholders."""
+        return self.count_many([text])[0]
+
+    def count_many(self, texts, num_threads=8):
+        """
+        Return the number of tokens in the prompt for each text in place of the placeholders, as a list in the same
+        order. The middles of the texts (most of their tokens) go through the cache, the seams are encoded in one batch.
+        """
+        middles = []
+        seams = []
+        seam_owners = []
+        for index, text in enumerate(texts):
+            text_head, text_middle, text_tail = split_at_seams(text)
+            middles.append(text_middle or "")
+            for pieces in self.message_pieces:
+                # The content alternates static pieces and the text, and whatever lies between two middles is a seam
+                run = ""
+                for position, (head, middle, tail) in enumerate(pieces):
+                    if position:
+                        run += text_head
+                        if text_middle is not None:
+                            seams.append(run)
+                            seam_owners.append(index)
+                            run = text_tail
+                    run += head
+                    if middle is not None:
+                        seams.append(run)
+                        seam_owners.append(index)
+                        run = tail
+                seams.append(run)
+                seam_owners.append(index)
+
+        num_placeholders = sum(len(pieces) - 1 for pieces in self.message_pieces)
+        counts = [self.static_tokens + num_tokens * num_placeholders
+                  for num_tokens in self.count_strings(middles, num_threads)]
+        seam_counts = self.encoding.encode_batch(seams, num_threads=num_threads, disallowed_special=())
+        for index, tokens in zip(seam_owners, seam_counts):
+            counts[index] += len(tokens)
+        return counts
+
+
+class IncrementalTokenCounter:
+    """
+    Counts the tokens in a text that is edited between counts.
+
+    The text is split into segments at safe token boundaries, and the token count of each segment is cached, so a
+    recount only encodes the segments that were changed since the previous count.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.segment_token_counts = {}
+
+    @property
+    def encoding(self):
+        # Looked up on first use, so a counter can be created before the encoding has finished loading
+        return get_encoding(self.model)
+
+    def count_text(self, text):
+        """Return the number of tokens in text, encoding only segments that were not in the previous text."""
+        segment_token_counts = {}
+        num_tokens = 0
+        for segment in split_at_safe_boundaries(text):
+            if segment not in segment_token_counts:
+                segment_token_counts[segment] = self.segment_token_counts.get(segment)
+                if segment_token_counts[segment] is None:
+                    segment_token_counts[segment] = len(self.encoding.encode(segment, disallowed_special=()))
+            num_tokens += segment_token_counts[segment]
+
+        # Only the counts for the current segments are kept
+        self.segment_token_counts = segment_token_counts
+        return num_tokens
+
+    def count_message(self, text):
+        """Return the number of tokens used by text sent as the content of a single message."""
+        return self.count_text(text) + num_tokens_from_messages([""], self.model)
+
+
+if __name__ == "__main__":
+    download_tokenizer_files()